@@ -1,11 +1,23 @@
+__version__ = "0.2.0"
+
 
 from .sampler import frame_rate
 from .sampler import write_wav
 
+from . import blocks
+from . import cache
+from . import config
+from . import dynamics
+from . import instrument
+from . import resample
+
 from .generators import tone
 from .generators import beep
 from .generators import silence
 
+from . import seekable
+from . import streaming
+
 from .util import crop
 from .util import crop_at_zero_crossing
 from .util import crop_with_fades
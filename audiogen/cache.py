@@ -0,0 +1,352 @@
+'''
+Rendered audio cache
+
+Stores finite renders as compact arrays rather than lists of Python
+floats. Entries larger than `spill_bytes` are written to disk and
+memory-mapped. Least recently used entries are evicted once the
+in-memory or on-disk byte budgets are exceeded.
+
+Entries are stored as float64 by default, so that cached replays match
+the uncached render exactly. float32 and int16 storage halve and quarter
+the footprint, at the cost of precision, and are opt-in.
+
+Cached entries replay as block generators of `array('d')` blocks (see
+`audiogen.blocks`); float64 entries are copied out a block at a time.
+
+The optional render cache (see `use_render_cache()`) persists finished
+PCM renders on disk, so they can be shared between processes.
+'''
+
+import os
+import sys
+import mmap
+import array
+import hashlib
+import logging
+import tempfile
+import functools
+import collections
+
+import audiogen.blocks as blocks
+import audiogen.sampler as sampler
+
+logger = logging.getLogger(__name__)
+
+# full scale for int16 cache entries
+INT16_SCALE = 2**15 - 1
+
+
+class CacheEntry(object):
+    '''
+    One cached render
+
+    `data` is a read-only memoryview of the stored samples, in the entry's
+    `typecode` ('f', 'd' or 'h'). `path` is set for memory-mapped entries.
+    '''
+    def __init__(self, data, typecode, path=None):
+        self.data = data
+        self.typecode = typecode
+        self.path = path
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def blocks(self, block_size=None):
+        '''
+        Replay the entry as a block generator
+
+        Yields `array('d')` blocks. int16 entries are scaled back to
+        [-1, 1].
+        '''
+        size = blocks._block_size(block_size)
+        for start in range(0, len(self.data), size):
+            chunk = self.data[start:start + size]
+            if self.typecode == 'd':
+                block = array.array('d')
+                block.frombytes(chunk.cast('B'))
+                yield block
+            elif self.typecode == 'h':
+                yield array.array('d', [s / INT16_SCALE for s in chunk])
+            else:
+                yield array.array('d', chunk)
+
+    def samples(self):
+        '''Replay the entry as a per-sample generator'''
+        return blocks.to_samples(self.blocks())
+
+
+class SampleCache(object):
+    '''
+    LRU cache of finite renders with a byte budget
+
+    `max_bytes` bounds entries held in memory and `max_disk_bytes` bounds
+    memory-mapped entries, which are stored in `directory` (a temporary
+    directory by default). Entries of more than `spill_bytes` go to disk.
+    `typecode` selects the storage format: 'd' (float64, lossless), or
+    the lossy 'f' (float32) or 'h' (int16, for audio already within
+    [-1, 1]).
+    '''
+    def __init__(self, max_bytes=64 * 2**20, max_disk_bytes=2**30, spill_bytes=2**20,
+                 directory=None, typecode='d'):
+        if typecode not in ('f', 'd', 'h'):
+            raise ValueError("Unsupported cache typecode {0}".format(typecode))
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_bytes = spill_bytes
+        self.directory = directory
+        self.typecode = typecode
+        self.entries = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''Return the entry for `key`, or None, marking it recently used'''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, blocks_):
+        '''Store the finite block generator (or iterable of blocks) `blocks_` under `key`'''
+        data = array.array(self.typecode)
+        for block in blocks_:
+            if self.typecode == 'h':
+                data.extend(max(-INT16_SCALE - 1, min(INT16_SCALE, int(round(s * INT16_SCALE))))
+                            for s in block)
+            elif isinstance(block, array.array) and block.typecode == self.typecode:
+                data.extend(block)
+            else:
+                data.fromlist(block.tolist() if hasattr(block, "tolist") else list(block))
+        self.discard(key)
+
+        if data.itemsize * len(data) > self.spill_bytes:
+            entry = self._spill(data)
+            self.disk_bytes += entry.nbytes
+        else:
+            entry = CacheEntry(memoryview(data).toreadonly(), self.typecode)
+            self.memory_bytes += entry.nbytes
+        self.entries[key] = entry
+        self._evict()
+        return entry
+
+    def discard(self, key):
+        '''Remove the entry for `key`, if any'''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.path is None:
+            self.memory_bytes -= entry.nbytes
+        else:
+            self.disk_bytes -= entry.nbytes
+            try:
+                # the mapping stays valid for replays still in progress
+                os.unlink(entry.path)
+            except OSError:
+                logger.debug("Unable to remove cache file {0}".format(entry.path))
+
+    def clear(self):
+        for key in list(self.entries):
+            self.discard(key)
+
+    def _spill(self, data):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="audiogen-cache-")
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".pcm")
+        with os.fdopen(fd, "wb") as f:
+            data.tofile(f)
+        if len(data) == 0:
+            return CacheEntry(memoryview(data).toreadonly(), self.typecode, path)
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return CacheEntry(memoryview(mapped).cast(self.typecode), self.typecode, path)
+
+    def _evict(self):
+        for key, entry in list(self.entries.items()):
+            if self.memory_bytes <= self.max_bytes and self.disk_bytes <= self.max_disk_bytes:
+                return
+            if entry.path is None and self.memory_bytes > self.max_bytes \
+                    or entry.path is not None and self.disk_bytes > self.max_disk_bytes:
+                logger.debug("Evicting cache entry {0!r}".format(key))
+                self.discard(key)
+
+
+# shared cache used by the decorators below
+sample_cache = SampleCache()
+
+
+def _cache_key(f, args, kwargs):
+    return (f.__module__, f.__qualname__, sampler.FRAME_RATE, args,
+            tuple(sorted(kwargs.items())))
+
+
+def _cached_entry(f, render, cache, args, kwargs):
+    store = sample_cache if cache is None else cache
+    key = _cache_key(f, args, kwargs)
+    entry = store.get(key)
+    if entry is None:
+        entry = store.put(key, render(*args, **kwargs))
+    return entry
+
+
+def cache_finite_blocks(f, cache=None):
+    '''Decorator to cache audio blocks produced by the wrapped block generator.'''
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        return _cached_entry(f, f, cache, args, kwargs).blocks()
+    return wrap
+
+
+def cache_finite_samples(f, cache=None):
+    '''Decorator to cache audio samples produced by the wrapped generator.'''
+    def render(*args, **kwargs):
+        return blocks.from_samples(f(*args, **kwargs))
+
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        return _cached_entry(f, render, cache, args, kwargs).samples()
+    return wrap
+
+
+# Persistent render cache
+
+# Directory based cache shared between processes; None disables it.
+# Set with use_render_cache(), or the AUDIOGEN_RENDER_CACHE environment variable.
+render_cache = None
+
+
+class PcmRender(object):
+    '''
+    Sample generator over cached mono PCM audio
+
+    Iterates floats in [-1, 1] like the generator that was cached. `pcm`
+    holds the little endian PCM bytes `sample_width` bytes wide;
+    `sampler.write_wav()` writes it directly, without re-encoding, when
+    the widths match.
+    '''
+    def __init__(self, pcm, sample_width, path=None):
+        self.pcm = pcm
+        self.sample_width = sample_width
+        self.path = path
+        self._samples = blocks.to_samples(self.blocks())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._samples)
+
+    def __len__(self):
+        return len(self.pcm) // self.sample_width
+
+    def blocks(self, block_size=None):
+        '''Decode the PCM as a block generator'''
+        width = self.sample_width
+        typecode = sampler._integer_typecode(width)
+        low, high = -2**(width * 8 - 1), 2**(width * 8 - 1) - 1
+        scale = (high - low) / 2.
+        size = blocks._block_size(block_size) * width
+        for start in range(0, len(self.pcm), size):
+            ints = array.array(typecode)
+            ints.frombytes(self.pcm[start:start + size])
+            if sys.byteorder == 'big':
+                ints.byteswap()
+            # offset by half a step away from zero so that re-encoding with
+            # sampler.sample(), which truncates, reproduces the same integers
+            if width == 1:
+                ints = [i - 128 for i in ints]
+            yield array.array('d', [
+                max(-1., min(1., (i + (0.5 if i >= 0 else -0.5) - low) / scale - 1))
+                for i in ints])
+
+
+class RenderCache(object):
+    '''
+    Content addressed cache of rendered PCM audio in `directory`
+
+    Entries are keyed on the render function, its arguments, FRAME_RATE,
+    SAMPLE_WIDTH and the audiogen version, and written atomically so that
+    several processes can share one directory. Cached renders are served
+    from memory-mapped files.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, f, args, kwargs):
+        import audiogen
+        description = repr((f.__module__, f.__qualname__, args, tuple(sorted(kwargs.items())),
+                            sampler.FRAME_RATE, sampler.SAMPLE_WIDTH, audiogen.__version__))
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pcm")
+
+    def get(self, key):
+        '''Return a PcmRender for `key`, or None if it isn't cached'''
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return PcmRender(b"", sampler.SAMPLE_WIDTH, path)
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        return PcmRender(memoryview(mapped), sampler.SAMPLE_WIDTH, path)
+
+    def put(self, key, samples):
+        '''Encode the finite sample generator `samples` as PCM and store it under `key`'''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in sampler.wav_blocks(blocks.from_samples(samples, sampler.BUFFER_SIZE),
+                                                sampler.SAMPLE_WIDTH):
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return self.get(key)
+
+
+def use_render_cache(directory):
+    '''Enable the persistent render cache in `directory`; None disables it'''
+    global render_cache
+    render_cache = None if directory is None else RenderCache(directory)
+    return render_cache
+
+
+def cache_rendered(f):
+    '''
+    Decorator to cache the finite mono render of `f` in the render cache
+
+    Calls `f` as usual while no render cache is enabled. Otherwise, returns
+    a `PcmRender` of the cached audio, rendering and storing it first if
+    needed.
+    '''
+    @functools.wraps(f)
+    def wrap(*args, **kwargs):
+        if render_cache is None:
+            return f(*args, **kwargs)
+        key = render_cache.key(f, args, kwargs)
+        render = render_cache.get(key)
+        if render is None:
+            logger.debug("Rendering {0}{1!r} into the render cache".format(f.__qualname__, args))
+            render = render_cache.put(key, f(*args, **kwargs))
+        return render
+    return wrap
+
+
+if os.environ.get("AUDIOGEN_RENDER_CACHE"):
+    use_render_cache(os.environ["AUDIOGEN_RENDER_CACHE"])
@@ -0,0 +1,62 @@
+'''
+Render configuration
+
+The frame rate, sample width and block size of a render are held in an
+immutable `RenderConfig`. The current configuration is a context
+variable, so each thread and asyncio task has its own, and renders at
+different rates can run concurrently in one process:
+
+    with audiogen.config.using(frame_rate=8000):
+        audiogen.sampler.write_wav(f, audiogen.tone(440))
+
+`sampler.FRAME_RATE`, `sampler.SAMPLE_WIDTH` and `sampler.BLOCK_SIZE`
+read the current configuration.
+
+Generators and filters read the configuration when they're built, or,
+for generator functions, when first advanced, so render them in the
+context they were built in. `audiogen.streaming` and `audiogen.playback`
+render in the context of their caller, and `audiogen.parallel` passes
+the configuration on to its worker processes. Threads started otherwise
+begin with the default configuration.
+'''
+
+import contextlib
+import contextvars
+import collections
+
+
+class RenderConfig(collections.namedtuple("RenderConfig", "frame_rate sample_width block_size")):
+    '''
+    Immutable render configuration
+
+    `frame_rate` in Hertz, `sample_width` of output samples in bytes
+    (2 = 16 bit) and `block_size`, the samples per block of block
+    generators, see `audiogen.blocks`.
+    '''
+    __slots__ = ()
+
+
+DEFAULT = RenderConfig(frame_rate=44100, sample_width=2, block_size=1024)
+
+_current = contextvars.ContextVar("audiogen_render_config", default=DEFAULT)
+
+
+def current():
+    '''Return the current `RenderConfig`'''
+    return _current.get()
+
+
+@contextlib.contextmanager
+def using(config=None, **changes):
+    '''
+    Make a configuration current within the `with` block
+
+    Uses `config`, or by default the current configuration, with the
+    fields given as keyword arguments changed. Yields the configuration.
+    '''
+    config = (current() if config is None else config)._replace(**changes)
+    token = _current.set(config)
+    try:
+        yield config
+    finally:
+        _current.reset(token)
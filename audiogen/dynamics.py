@@ -0,0 +1,377 @@
+'''
+Dynamics processing
+
+Level control stages working on blocks (see `audiogen.blocks`) with
+bounded latency and memory.
+
+`Limiter` is a lookahead peak limiter: it delays the signal by
+`lookahead` seconds so that it can lower the gain smoothly *before* a
+peak arrives, rather than clipping it:
+
+    limiter = Limiter(ceiling=0.9)
+    limited = (limiter(b) for b in gen)
+    tail = limiter.flush()
+
+The gain needed to bring each sample under the ceiling is held for the
+lookahead plus `release` seconds, then smoothed with a moving average as
+long as the lookahead, so the gain always reaches its target by the time
+the peak leaves the delay line, and ramps back up over the lookahead
+once `release` has passed.
+
+`LoudnessMeter` measures loudness per ITU-R BS.1770 / EBU R128 in LUFS,
+and `normalize_blocks()` normalizes a stream to a target loudness in the
+same pass that renders it, see below.
+'''
+
+import math
+import array
+import itertools
+import collections
+
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
+import audiogen.blocks as blocks
+import audiogen.filters as filters
+import audiogen.sampler as sampler
+
+
+def _sliding_min(samples, width):
+    '''
+    Return the minimum of each run of `width` values of NumPy array `samples`
+
+    Returns `len(samples) - width + 1` minima, computed from the running
+    minima forwards and backwards through chunks of `width` values
+    (van Herk/Gil-Werman), in time independent of `width`.
+    '''
+    count = len(samples) - width + 1
+    padded = numpy.full(-(-len(samples) // width) * width, numpy.inf)
+    padded[:len(samples)] = samples
+    chunks = padded.reshape(-1, width)
+    forward = numpy.minimum.accumulate(chunks, axis=1).ravel()
+    backward = numpy.minimum.accumulate(chunks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return numpy.minimum(backward[:count], forward[width - 1:width - 1 + count])
+
+
+class Limiter(object):
+    '''
+    Streaming lookahead peak limiter for blocks of one channel
+
+    Call with each block in turn; returns a block of the same length,
+    delayed by `latency` samples. Call `flush()` at the end of the stream
+    for the last `latency` samples. Output stays within `ceiling` of
+    `center`.
+    '''
+    def __init__(self, ceiling=1.0, lookahead=0.005, release=0.05, center=0.0):
+        self.ceiling = float(ceiling)
+        self.center = float(center)
+        self.lookahead = max(1, int(lookahead * sampler.FRAME_RATE))
+        self.hold = self.lookahead + int(release * sampler.FRAME_RATE)
+        # the delayed input, the gains needed for the last hold - 1 samples
+        # and the last lookahead - 1 held gains being smoothed
+        self._delay = array.array('d', [self.center]) * self.latency
+        self._needed = array.array('d', [1.0]) * (self.hold - 1)
+        self._held = array.array('d', [1.0]) * self.latency
+        # pure Python state: running minimum of the needed gains and sum of held gains
+        self._window = None
+        self._sum = float(self.latency)
+
+    @property
+    def latency(self):
+        '''Output delay, in samples'''
+        return self.lookahead - 1
+
+    def __call__(self, block):
+        if len(block) == 0:
+            return array.array('d')
+        if numpy_loaded:
+            return self._limit_ndarray(block)
+        return self._limit_lists(block)
+
+    def flush(self):
+        '''Return the block of the last `latency` samples'''
+        return self(array.array('d', [self.center]) * self.latency)
+
+    def _limit_ndarray(self, block):
+        samples = blocks.as_ndarray(block)
+        count = len(samples)
+        needed = numpy.concatenate((blocks.as_ndarray(self._needed), self.ceiling /
+                                    numpy.maximum(numpy.abs(samples - self.center), self.ceiling)))
+        held = numpy.concatenate((blocks.as_ndarray(self._held), _sliding_min(needed, self.hold)))
+        sums = numpy.concatenate(((0.0,), numpy.cumsum(held)))
+        gains = (sums[self.lookahead:] - sums[:-self.lookahead]) / self.lookahead
+        delayed = numpy.concatenate((blocks.as_ndarray(self._delay), samples))
+        output = (delayed[:count] - self.center) * gains
+        # the moving average can round a hair past the needed gain
+        numpy.clip(output, -self.ceiling, self.ceiling, out=output)
+        output += self.center
+        self._needed = blocks.from_ndarray(needed[len(needed) - len(self._needed):])
+        self._held = blocks.from_ndarray(held[len(held) - self.latency:])
+        self._delay = blocks.from_ndarray(delayed[len(delayed) - self.latency:])
+        return blocks.from_ndarray(output)
+
+    def _limit_lists(self, block):
+        if self._window is None:
+            # (position, gain) pairs with increasing gains; the first is the minimum
+            self._window = collections.deque()
+            self._position = 0
+            for gain in self._needed:
+                self._push(gain)
+            self._delay = collections.deque(self._delay)
+            self._held = collections.deque(self._held)
+        output = array.array('d', block)
+        ceiling, center, lookahead = self.ceiling, self.center, self.lookahead
+        for i, sample in enumerate(block):
+            overshoot = abs(sample - center)
+            self._push(ceiling / overshoot if overshoot > ceiling else 1.0)
+            held = self._window[0][1]
+            self._held.append(held)
+            self._sum += held
+            gain = self._sum / lookahead
+            self._sum -= self._held.popleft()
+            self._delay.append(sample)
+            limited = (self._delay.popleft() - center) * gain
+            output[i] = center + max(-ceiling, min(ceiling, limited))
+        return output
+
+    def _push(self, gain):
+        window = self._window
+        while window and window[-1][1] >= gain:
+            window.pop()
+        window.append((self._position, gain))
+        if window[0][0] <= self._position - self.hold:
+            window.popleft()
+        self._position += 1
+
+
+def limit_blocks(source, ceiling=1.0, lookahead=0.005, release=0.05, center=0.0):
+    '''
+    Peak limit a block generator with a `Limiter`
+
+    The limiter's delay is compensated for: the output lines up with and
+    is as long as the input, in blocks of the size of the first non-empty
+    one.
+    '''
+    source = iter(source)
+    first = next((block for block in source if len(block)), None)
+    if first is None:
+        return iter(())
+    limiter = Limiter(ceiling, lookahead, release, center)
+
+    def limited():
+        skip = limiter.latency
+        for block in itertools.chain((first,), source):
+            block = limiter(block)
+            if skip:
+                drop = min(skip, len(block))
+                block = block[drop:]
+                skip -= drop
+            if len(block):
+                yield block
+        yield limiter.flush()[skip:]
+    return blocks.rechunk(limited(), len(first))
+
+
+# Loudness, ITU-R BS.1770 / EBU R128
+
+# gating thresholds, in LUFS and LU below the absolute gated loudness
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# gating block loudness histogram bins per LU, from ABSOLUTE_GATE to +10 LUFS
+HISTOGRAM_RESOLUTION = 10
+
+
+def k_weighting():
+    '''
+    Return the BS.1770 K-weighting filter at `sampler.FRAME_RATE`
+
+    Returns second order sections for `filters.sos()`: the high shelf
+    modelling the head, then the RLB high pass, designed for any rate as
+    libebur128 does.
+    '''
+    K = math.tan(math.pi * 1681.974450955533 / sampler.FRAME_RATE)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = ((Vh + Vb * K / Q + K * K) / a0, 2 * (K * K - Vh) / a0,
+             (Vh - Vb * K / Q + K * K) / a0, 1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0)
+    K = math.tan(math.pi * 38.13547087602444 / sampler.FRAME_RATE)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    high_pass = (1.0, -2.0, 1.0, 1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0)
+    return (shelf, high_pass)
+
+
+def _lufs(energy):
+    return -0.691 + 10 * math.log10(energy) if energy > 0 else float("-inf")
+
+
+class LoudnessMeter(object):
+    '''
+    Streaming ITU-R BS.1770 / EBU R128 loudness meter
+
+    Call `update()` with each block, or each multichannel `blocks.Frames`,
+    in turn. `weights` are the channel weights, by default 1.0 for every
+    channel; BS.1770 weighs surround channels 1.41.
+
+    Memory use is bounded: the integrated loudness is gated from a
+    histogram of gating block loudness, to 1 / `HISTOGRAM_RESOLUTION` LU.
+    '''
+    def __init__(self, weights=None):
+        self.weights = weights
+        self.samples = 0
+        # gating blocks are 400 ms, overlapping by 75%, so step 100 ms
+        self.step = max(1, int(0.1 * sampler.FRAME_RATE))
+        self._engines = None
+        self._energy = 0.0
+        self._filled = 0
+        # weighted mean square of the last 30 steps, for up to 3 s windows
+        self._steps = collections.deque(maxlen=30)
+        bins = int(-ABSOLUTE_GATE + 10) * HISTOGRAM_RESOLUTION
+        self._counts = [0] * bins
+        self._energies = [0.0] * bins
+
+    def update(self, block):
+        '''Measure a block or `blocks.Frames`'''
+        channels = block.channels if isinstance(block, blocks.Frames) else (block,)
+        if self._engines is None:
+            self._engines = [filters.BlockSOS(k_weighting()) for channel in channels]
+            if self.weights is None:
+                self.weights = [1.0] * len(channels)
+        squares = None
+        for engine, weight, channel in zip(self._engines, self.weights, channels):
+            weighted = engine(channel)
+            if numpy_loaded:
+                weighted = blocks.as_ndarray(weighted) ** 2 * weight
+                squares = weighted if squares is None else squares + weighted
+            else:
+                weighted = [s * s * weight for s in weighted]
+                squares = weighted if squares is None else \
+                    [a + b for a, b in zip(squares, weighted)]
+        start = 0
+        while start < len(squares):
+            count = min(self.step - self._filled, len(squares) - start)
+            self._energy += float(sum(squares[start:start + count]))
+            self._filled += count
+            start += count
+            if self._filled == self.step:
+                self._complete_step()
+        self.samples += len(squares)
+
+    def _complete_step(self):
+        self._steps.append(self._energy / self.step)
+        self._energy, self._filled = 0.0, 0
+        if len(self._steps) >= 4:
+            energy = self._mean(4)
+            loudness = _lufs(energy)
+            if loudness > ABSOLUTE_GATE:
+                i = min(int((loudness - ABSOLUTE_GATE) * HISTOGRAM_RESOLUTION),
+                        len(self._counts) - 1)
+                self._counts[i] += 1
+                self._energies[i] += energy
+
+    def _mean(self, steps):
+        last = list(self._steps)[-steps:]
+        return sum(last) / len(last) if last else 0.0
+
+    @property
+    def momentary(self):
+        '''Loudness of the last 400 ms, in LUFS'''
+        return _lufs(self._mean(4))
+
+    @property
+    def short_term(self):
+        '''Loudness of the last 3 s, in LUFS'''
+        return _lufs(self._mean(30))
+
+    @property
+    def integrated(self):
+        '''Gated loudness of everything measured so far, in LUFS; -inf if silent'''
+        counts, energies = self._counts, self._energies
+        if not self.samples or not any(counts):
+            if len(self._steps) < 4 and self._filled + len(self._steps) * self.step > 0:
+                # shorter than a gating block: measure what there is
+                partial = (sum(self._steps) * self.step + self._energy) / \
+                    (len(self._steps) * self.step + self._filled)
+                return _lufs(partial) if _lufs(partial) > ABSOLUTE_GATE else float("-inf")
+            return float("-inf")
+        threshold = _lufs(sum(energies) / sum(counts)) + RELATIVE_GATE
+        first = max(0, int((threshold - ABSOLUTE_GATE) * HISTOGRAM_RESOLUTION))
+        count = sum(counts[first:])
+        return _lufs(sum(energies[first:]) / count) if count else float("-inf")
+
+
+def integrated_loudness(source, weights=None):
+    '''Return the integrated loudness of a block or `blocks.Frames` generator, in LUFS'''
+    meter = LoudnessMeter(weights)
+    for block in source:
+        meter.update(block)
+    return meter.integrated
+
+
+def _ramp(block, start, end):
+    # scale block by a gain ramping linearly from start to end
+    if not len(block):
+        return array.array('d')
+    if start == end:
+        if numpy_loaded:
+            return blocks.from_ndarray(blocks.as_ndarray(block) * end)
+        return array.array('d', [s * end for s in block])
+    step = (end - start) / len(block)
+    if numpy_loaded:
+        gains = start + step * numpy.arange(1, len(block) + 1)
+        return blocks.from_ndarray(blocks.as_ndarray(block) * gains)
+    return array.array('d', [s * (start + step * (i + 1)) for i, s in enumerate(block)])
+
+
+def normalize_blocks(source, target=-23.0, window=10.0, max_gain=20.0, ceiling=-1.0,
+                     lookahead=0.005, release=0.05):
+    '''
+    Normalize a block generator to `target` integrated loudness, in LUFS
+
+    Output is delayed by up to `window` seconds, holding at most that
+    much audio. Each block leaving the delay is scaled to bring the
+    integrated loudness measured so far, up to `window` seconds past the
+    block, to the target, ramping from the previous block's gain. Streams
+    shorter than `window` are measured in full before any output, so they
+    are normalized exactly, in one pass.
+
+    Gain is capped at `max_gain` dB. Unless `ceiling` is None, the result
+    is peak limited to `ceiling` dBFS with a `Limiter`.
+    '''
+    meter = LoudnessMeter()
+    size = int(window * sampler.FRAME_RATE)
+
+    def gain():
+        loudness = meter.integrated
+        if loudness == float("-inf"):
+            return 1.0
+        return 10 ** (min(target - loudness, max_gain) / 20.)
+
+    def normalized():
+        pending = collections.deque()
+        pending_samples = 0
+        current = None
+        for block in source:
+            meter.update(block)
+            pending.append(block)
+            pending_samples += len(block)
+            while pending_samples - len(pending[0]) >= size:
+                block = pending.popleft()
+                pending_samples -= len(block)
+                new = gain()
+                yield _ramp(block, new if current is None else current, new)
+                current = new
+        new = gain()
+        for block in pending:
+            yield _ramp(block, new if current is None else current, new)
+            current = new
+
+    if ceiling is None:
+        return normalized()
+    return limit_blocks(normalized(), 10 ** (ceiling / 20.), lookahead, release)
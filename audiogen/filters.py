@@ -5,17 +5,161 @@ Assorted filters
 '''
 
 import math
+import cmath
+import array
 import collections
 
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
+try:
+    import scipy.signal
+    scipy_loaded = numpy_loaded
+except ImportError:
+    scipy_loaded = False
+
+import audiogen.blocks as blocks
+import audiogen.instrument as instrument
 import audiogen.sampler as sampler
 
 TWO_PI = 2 * math.pi
 
+# samples per sub-block of the NumPy state space filter engine
+SUBBLOCK = 64
+# highest filter order the state space engine handles; its matrix powers
+# lose precision on higher order filters with poles close to 1
+SUBBLOCK_ORDER = 2
+
+
+class _StateSpace(object):
+    # Block state space form of a direct form II transposed filter, for
+    # NumPy without SciPy. The output of each sub-block of SUBBLOCK
+    # samples is the sum of matrix products of its input and of the
+    # filter state at its start, so only the state is carried from one
+    # sub-block to the next in Python.
+    def __init__(self, b, a, length=SUBBLOCK):
+        order = len(a) - 1
+        self.length = length
+        A = numpy.zeros((order, order))
+        A[:, 0] = -numpy.array(a[1:])
+        A[numpy.arange(order - 1), numpy.arange(1, order)] = 1
+        B = numpy.array(b[1:]) - numpy.array(a[1:]) * b[0]
+        # A^0 to A^length
+        self.powers = [numpy.eye(order)]
+        for k in range(length):
+            self.powers.append(self.powers[-1] @ A)
+        # output k from the state: the first row of A^k
+        self.from_state = numpy.array([p[0] for p in self.powers[:length]])
+        # state after input k: A^k B
+        self.input_state = numpy.array([p @ B for p in self.powers[:length]])
+        # output from the input: the lower triangular Toeplitz matrix of the impulse response
+        response = numpy.concatenate(((b[0],), self.input_state[:length - 1, 0]))
+        lag = numpy.arange(length)[:, None] - numpy.arange(length)[None, :]
+        self.from_input = numpy.where(lag >= 0, response[numpy.maximum(lag, 0)], 0.0)
+
+    def __call__(self, x, state):
+        length = self.length
+        full = len(x) // length * length
+        out = numpy.empty(len(x))
+        if full:
+            inputs = x[:full].reshape(-1, length)
+            outputs = inputs @ self.from_input.T
+            # each sub-block's input contribution to the state at its end
+            drives = inputs @ self.input_state[::-1]
+            states = numpy.empty((len(inputs), len(state)))
+            step = self.powers[length]
+            for k, drive in enumerate(drives):
+                states[k] = state
+                state = step @ state + drive
+            outputs += states @ self.from_state.T
+            out[:full] = outputs.ravel()
+        rest = len(x) - full
+        if rest:
+            x = x[full:]
+            out[full:] = self.from_input[:rest, :rest] @ x + self.from_state[:rest] @ state
+            state = self.powers[rest] @ state + x @ self.input_state[:rest][::-1]
+        return out, state
+
+
+class BlockIIR(object):
+    '''
+    Direct form II transposed IIR filter engine for blocks of samples
+
+    Takes the same `A` (input) and `B` (output) coefficients as `iir()`,
+    i.e. y[n] = sum(A[k] * x[n - k]) + sum(B[k - 1] * y[n - k]).
+
+    Calling the engine with a block of samples returns the filtered block.
+    Filter state is carried from one call to the next, so successive
+    blocks of a stream are filtered seamlessly. There is no output delay.
+
+    Uses `scipy.signal.lfilter` when SciPy is installed. With NumPy alone,
+    first and second order filters process sub-blocks of `SUBBLOCK`
+    samples at once in state space form. Other filters run a pure Python
+    recurrence.
+    '''
+    def __init__(self, A, B):
+        order = max(len(A) - 1, len(B))
+        # lfilter convention: a[0] * y[n] = sum(b[k] * x[n - k]) - sum(a[k] * y[n - k])
+        self.b = [float(c) for c in A] + [0.] * (order + 1 - len(A))
+        self.a = [1.] + [-float(c) for c in B] + [0.] * (order - len(B))
+        self.order = order
+        self.engine = None
+        if scipy_loaded:
+            self.state = numpy.zeros(order)
+        elif numpy_loaded and 0 < order <= SUBBLOCK_ORDER:
+            self.engine = _StateSpace(self.b, self.a)
+            self.state = numpy.zeros(order)
+        else:
+            self.state = [0.] * order
+
+    def __call__(self, block):
+        if self.order == 0:
+            return array.array('d', [self.b[0] * x for x in block])
+        if scipy_loaded:
+            y, self.state = scipy.signal.lfilter(
+                self.b, self.a, blocks.as_ndarray(block), zi=self.state)
+            return blocks.from_ndarray(y)
+        if self.engine is not None:
+            y, self.state = self.engine(blocks.as_ndarray(block), self.state)
+            return blocks.from_ndarray(y)
+        if self.order == 2:
+            return self._biquad(block)
+        return self._direct_form(block)
+
+    def _biquad(self, block):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+        z0, z1 = self.state
+        out = array.array('d', bytes(8 * len(block)))
+        for n, x in enumerate(block):
+            y = b0 * x + z0
+            z0 = b1 * x - a1 * y + z1
+            z1 = b2 * x - a2 * y
+            out[n] = y
+        self.state = [z0, z1]
+        return out
+
+    def _direct_form(self, block):
+        b0 = self.b[0]
+        taps = list(zip(self.b[1:], self.a[1:]))
+        z = self.state + [0.]
+        out = array.array('d', bytes(8 * len(block)))
+        for n, x in enumerate(block):
+            y = b0 * x + z[0]
+            z = [b * x - a * y + zNext for (b, a), zNext in zip(taps, z[1:])] + [0.]
+            out[n] = y
+        self.state = z[:-1]
+        return out
+
 
 def iir(A, B):
     # Returns an IIR filter function based on the
     # provided input and output coefficient arrays
     #
+    @instrument.instrumented("iir")
     def filter(in_):
         input_ = iter(in_)
         # use deques as ring buffers
@@ -34,6 +178,33 @@ def iir(A, B):
             # clear the remaining samples in the buffer
             while len(outputs) > 0:
                 yield outputs.pop()
+
+    @instrument.instrumented("iir.blocks")
+    def filter_blocks(in_):
+        # Block version of filter(): the same output, including the
+        # max(len(B), 1) sample output delay and trailing buffer flush,
+        # regrouped into blocks the size of the first input block.
+        engine = BlockIIR(A, B)
+        pending = array.array('d', bytes(8 * max(len(B), 1)))
+        size = None
+        for block in in_:
+            if not size:
+                size = len(block)
+            pending.extend(engine(block))
+            while size and len(pending) > size:
+                yield pending[:size]
+                del pending[:size]
+        while size and len(pending) > size:
+            yield pending[:size]
+            del pending[:size]
+        yield pending
+
+    def filter_frames(in_):
+        # filter_blocks() on each channel of a blocks.Frames generator
+        yield from blocks.lockstep([filter_blocks(channel) for channel in blocks.split(in_)])
+
+    filter.blocks = filter_blocks
+    filter.frames = filter_frames
     return filter
 
 
@@ -113,7 +284,8 @@ def low_pass_four_stage(cutoff: float):
 
     Equivalent to cascading single pole LPF four times.
 
-    `cutoff` is cutoff frequency in Hz.
+    `cutoff` is cutoff frequency in Hz. At low cutoffs, prefer the
+    numerically stable second order sections of `butterworth()`.
 
     http://www.dspguide.com/ch19/2.htm
     '''
@@ -158,3 +330,175 @@ def high_pass(cutoff: float):
     a1 = -(1 + x) / 2.
     b1 = x
     return iir([a0, a1], [b1])
+
+
+# Second order section (biquad cascade) filters
+
+# designed sections keyed on (family, kind, frequency, order, ripple, FRAME_RATE)
+sos_cache = {}
+
+
+class BlockSOS(object):
+    '''
+    Cascade of second order sections filter engine for blocks of samples
+
+    `sections` is a sequence of (b0, b1, b2, a0, a1, a2) rows, in the
+    `scipy.signal` "sos" layout, each normalized so that a0 == 1.
+
+    Like `BlockIIR`, calling the engine with a block returns the filtered
+    block and carries filter state from one call to the next.
+    '''
+    def __init__(self, sections):
+        self.sections = [tuple(float(c) for c in section) for section in sections]
+        if scipy_loaded:
+            self.sos = numpy.array(self.sections, dtype=numpy.float64)
+            self.state = numpy.zeros((len(self.sections), 2))
+        else:
+            self.stages = [BlockIIR(section[:3], [-section[4], -section[5]])
+                           for section in self.sections]
+
+    def __call__(self, block):
+        if scipy_loaded:
+            y, self.state = scipy.signal.sosfilt(self.sos, blocks.as_ndarray(block), zi=self.state)
+            return blocks.from_ndarray(y)
+        for stage in self.stages:
+            block = stage(block)
+        return block
+
+
+def sos(sections):
+    '''
+    Returns a second order section cascade filter function
+
+    Unlike `iir()` filters, the output has no delay and is the same
+    length as the input. As with `iir()`, the returned function filters
+    a sample generator, its `blocks` attribute filters a block generator
+    and its `frames` attribute a generator of multichannel `blocks.Frames`.
+    '''
+    @instrument.instrumented("sos.blocks")
+    def filter_blocks(in_):
+        engine = BlockSOS(sections)
+        for block in in_:
+            yield engine(block)
+
+    @instrument.instrumented("sos.frames")
+    def filter_frames(in_):
+        engines = None
+        for frame in in_:
+            if engines is None:
+                engines = [BlockSOS(sections) for channel in frame.channels]
+            yield blocks.Frames(engine(b) for engine, b in zip(engines, frame.channels))
+
+    def filter(in_):
+        return blocks.to_samples(filter_blocks(blocks.from_samples(in_)))
+
+    filter.blocks = filter_blocks
+    filter.frames = filter_frames
+    filter.sections = sections
+    return filter
+
+
+def butterworth(kind, frequency, order=4):
+    '''
+    Butterworth filter as a cascade of second order sections
+
+    `kind` is one of "low_pass", "high_pass" or "band_pass". `frequency`
+    is the -3 dB cutoff in Hz, or a (low, high) pair of band edges in Hz
+    for "band_pass". Band pass filters have twice `order` poles.
+    '''
+    return sos(design_sos("butterworth", kind, frequency, order))
+
+
+def chebyshev(kind, frequency, order=4, ripple=1.0):
+    '''
+    Chebyshev type I filter as a cascade of second order sections
+
+    As for `butterworth()`, with `ripple` dB of passband ripple. `frequency`
+    is the passband edge, where the response leaves the ripple band.
+    '''
+    return sos(design_sos("chebyshev", kind, frequency, order, ripple))
+
+
+def design_sos(family, kind, frequency, order=4, ripple=None):
+    '''
+    Return second order sections for a digital filter at the current FRAME_RATE
+
+    Designs are cached in `sos_cache`. See `butterworth()` and `chebyshev()`.
+    '''
+    if isinstance(frequency, (tuple, list)):
+        frequency = tuple(frequency)
+    key = family, kind, frequency, order, ripple, sampler.FRAME_RATE
+    if key not in sos_cache:
+        sos_cache[key] = _design_sos(*key)
+    return sos_cache[key]
+
+
+def _design_sos(family, kind, frequency, order, ripple, frame_rate):
+    # analog prototype poles, normalized to a 1 rad/s passband edge
+    if family == "butterworth":
+        poles = [cmath.exp(1j * math.pi * (2 * k + order + 1) / (2 * order))
+                 for k in range(order)]
+        gain = 1.0
+    elif family == "chebyshev":
+        epsilon = math.sqrt(10 ** (ripple / 10.) - 1)
+        v0 = math.asinh(1 / epsilon) / order
+        poles = [complex(-math.sinh(v0) * math.sin(theta), math.cosh(v0) * math.cos(theta))
+                 for theta in (math.pi * (2 * k + 1) / (2 * order) for k in range(order))]
+        # even order Chebyshev filters sit at the bottom of the ripple at DC
+        gain = 1.0 if order % 2 else 10 ** (-ripple / 20.)
+    else:
+        raise ValueError("Unknown filter family {0}".format(family))
+
+    # pre-warp frequencies for a bilinear transform of z = (1 + s) / (1 - s)
+    def warp(f):
+        return math.tan(math.pi * float(f) / frame_rate)
+
+    # analog zeros at the origin; all other zeros are at infinity
+    if kind == "low_pass":
+        wc = warp(frequency)
+        poles = [p * wc for p in poles]
+        zeros = []
+        reference = 0.
+    elif kind == "high_pass":
+        wc = warp(frequency)
+        poles = [wc / p for p in poles]
+        zeros = [0.] * order
+        reference = math.pi
+    elif kind == "band_pass":
+        low, high = warp(frequency[0]), warp(frequency[1])
+        w0, bw = math.sqrt(low * high), high - low
+        poles = [(p * bw + sign * cmath.sqrt((p * bw) ** 2 - 4 * w0 ** 2)) / 2
+                 for p in poles for sign in (1, -1)]
+        zeros = [0.] * order
+        reference = 2 * math.atan(w0)
+    else:
+        raise ValueError("Unknown filter kind {0}".format(kind))
+
+    # bilinear transform; zeros at infinity map to Nyquist
+    poles = [(1 + p) / (1 - p) for p in poles]
+    zeros = [(1 + z) / (1 - z) for z in zeros] + [-1.] * (len(poles) - len(zeros))
+
+    sections = [(1., -(z1 + z2).real, (z1 * z2).real, 1., -(p1 + p2).real, (p1 * p2).real)
+                for (z1, z2), (p1, p2) in zip(_pairs(zeros), _pairs(poles))]
+
+    # scale the first section for the desired passband gain
+    z = cmath.exp(1j * reference)
+    response = 1
+    for b0, b1, b2, a0, a1, a2 in sections:
+        response *= (b0 + b1 / z + b2 / z ** 2) / (a0 + a1 / z + a2 / z ** 2)
+    scale = gain / abs(response)
+    b0, b1, b2, a0, a1, a2 = sections[0]
+    sections[0] = (b0 * scale, b1 * scale, b2 * scale, a0, a1, a2)
+    return sections
+
+
+def _pairs(roots):
+    # Group roots into pairs with real products and sums: complex conjugates
+    # together, then the real roots two at a time (padded with a zero root).
+    roots = sorted(roots, key=lambda r: (abs(r.imag) < 1e-12, -abs(r)))
+    complexRoots = [r for r in roots if abs(r.imag) >= 1e-12 and r.imag > 0]
+    realRoots = [complex(r.real) for r in roots if abs(r.imag) < 1e-12]
+    if len(realRoots) % 2:
+        realRoots.append(0j)
+    return ([(r, r.conjugate()) for r in complexRoots]
+            + list(zip(realRoots[::2], realRoots[1::2])))
@@ -6,10 +6,24 @@ Assorted generators
 
 import logging
 
+import os
 import math
+import mmap
+import array
+import types
+import operator
+import fractions
 import itertools
 
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
 import audiogen.util as util
+import audiogen.cache as cache
+import audiogen.blocks as blocks
 import audiogen.sampler as sampler
 import audiogen.filters as filters
 
@@ -22,6 +36,7 @@ TWO_PI = 2 * math.pi
 bpf_cache = {}
 
 
+@cache.cache_rendered
 def beep(frequency=440, seconds=0.25, use_bpf=True):
     '''
     Generate a beep
@@ -34,44 +49,136 @@ def beep(frequency=440, seconds=0.25, use_bpf=True):
     n.b. By default, use_bpf=True, which causes the output to be shortened
          and bandpass filtered to avoid high bandwidth clicks from harsh
          volume transitions.
+
+    Beeps are served from the persistent render cache when it's enabled,
+    see `audiogen.cache.use_render_cache()`.
     '''
     if use_bpf:
-        if frequency not in bpf_cache:
+        key = frequency, sampler.FRAME_RATE
+        if key not in bpf_cache:
             bandwidthHz = max(frequency // 2 ** 6, 128)
             logger.debug(
                 f"Creating {bandwidthHz} Hz BPF centered at {frequency} Hz for beep")
-            bpf_cache[frequency] = filters.band_pass(frequency, bandwidthHz)
-        bpf = bpf_cache[frequency]
+            bpf_cache[key] = filters.band_pass(frequency, bandwidthHz)
+        bpf = bpf_cache[key]
 
         # lower volume 0.25 dB (~95% full scale) so BPF ripple doesn't exceed 0 dbFS
         # replace the final 0.03 seconds of the beep with silence so the bpf has room
         # to operate.
-        samples = bpf(bpf(
+        # filter a block at a time, see filters.BlockIIR
+        samples = blocks.to_samples(bpf.blocks(bpf.blocks(blocks.from_samples(
             itertools.chain(
                 util.crop(util.volume(tone(frequency), -0.25), seconds=(seconds - 0.03)),
                 silence(0.03)
-            )))
+            )))))
     else:
         samples = util.crop(util.volume(tone(frequency), -0.25), seconds=seconds)
     return samples
 
 
+class _ddsMethod(object):
+    '''
+    Method descriptor for DDS
+
+    Binds to the DDS instance it's called on, or to the class itself when
+    called on the class, so `DDS.dds()` uses the shared class settings and
+    LUT while `DDS(lutBits=10).dds()` uses the instance's.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.__doc__ = f.__doc__
+
+    def __get__(self, obj, cls=None):
+        return types.MethodType(self.f, cls if obj is None else obj)
+
+
 class DDS(object):
+    '''
+    Direct digital synthesis oscillators
+
+    The class level settings and LUT are shared by `DDS.dds()` and friends.
+    Create an instance to use other settings, e.g.
+
+        DDS(lutBits=10, quarterWave=True, interpolate=True).dds(440)
+
+    `lutTypecode` stores the LUT as float64 ('d') or float32 ('f') entries.
+    `quarterWave` stores only the first quarter of the sine wave, mirroring
+    it for the other three, and `interpolate` linearly interpolates between
+    LUT entries using the phase bits below the LUT index; both trade speed
+    for a smaller table or lower phase truncation spurs.
+    '''
     accumulatorBits = 24
     lutBits = 14
+    lutTypecode = 'd'
+    quarterWave = False
+    interpolate = False
 
     # lut will be generated once on first use of DDS.dds() or by calling DDS.generateLut() directly
     lut = None
-
-    @classmethod
+    _lutArray = None
+
+    def __init__(self, accumulatorBits=None, lutBits=None, lutTypecode=None,
+                 quarterWave=None, interpolate=None, lut=None):
+        settings = dict(accumulatorBits=accumulatorBits, lutBits=lutBits,
+                        lutTypecode=lutTypecode, quarterWave=quarterWave, interpolate=interpolate)
+        for name, value in settings.items():
+            if value is not None:
+                setattr(self, name, value)
+        self.lut = None
+        self._lutArray = None
+        if lut is not None:
+            self.loadLut(lut)
+
+    @_ddsMethod
+    def lutSize(cls):
+        '''Number of entries in the LUT for the current settings'''
+        if cls.quarterWave:
+            return 2 ** (cls.lutBits - 2) + 1
+        return 2 ** cls.lutBits
+
+    @_ddsMethod
     def generateLut(cls):
         import time
-        import sys
         phasePerLutItem = 2 * math.pi / 2 ** cls.lutBits
         start = time.time()
-        cls.lut = [math.sin(i * phasePerLutItem) for i in range(2 ** cls.lutBits)]
+        cls.lut = array.array(cls.lutTypecode,
+                              [math.sin(i * phasePerLutItem) for i in range(cls.lutSize())])
+        cls._lutArray = None
         generationTime = time.time() - start
         logger.debug('[dds] Generated DDS LUT in {} seconds'.format(generationTime))
+        cls._logLut()
+
+    @_ddsMethod
+    def loadLut(cls, source):
+        '''
+        Use a prebuilt LUT, e.g. one written by `saveLut()`
+
+        `source` is a filename, which is memory-mapped so that processes
+        share one copy of the table, or any buffer holding the LUT entries,
+        e.g. the `buf` of a `multiprocessing.shared_memory.SharedMemory`.
+        The LUT must match the current settings.
+        '''
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        lut = memoryview(source).cast('B').cast(cls.lutTypecode)
+        if len(lut) != cls.lutSize():
+            raise ValueError("LUT has {0} entries, expected {1}".format(len(lut), cls.lutSize()))
+        cls.lut = lut
+        cls._lutArray = None
+        cls._logLut()
+
+    @_ddsMethod
+    def saveLut(cls, filename):
+        '''Write the LUT to `filename` for `loadLut()`'''
+        if cls.lut is None:
+            cls.generateLut()
+        with open(filename, "wb") as f:
+            f.write(memoryview(cls.lut).cast('B'))
+
+    @_ddsMethod
+    def _logLut(cls):
+        lutBytes = memoryview(cls.lut).nbytes
         logger.debug('[dds] {} bit phase accumulator, {} bit DDS LUT'.format(
             cls.accumulatorBits,
             cls.lutBits,
@@ -79,106 +186,346 @@ class DDS(object):
         logger.debug(
             '[dds] {} bit ({:,} entry) LUT takes {:,} bytes of memory ({} bits / entry)'.format(
                 cls.lutBits,
-                2 ** cls.lutBits,
-                sys.getsizeof(cls.lut),
-                sys.getsizeof(cls.lut) / 2 ** cls.lutBits * 8,
+                len(cls.lut),
+                lutBytes,
+                lutBytes / len(cls.lut) * 8,
             ))
 
-    @classmethod
-    def dds(cls, freqHz, phaseOffsetRad=0):
+    @_ddsMethod
+    def _sampleLookup(cls):
+        # Returns a function from a phase accumulator value to a sample
+        lut = cls.lut
+        truncateBits = cls.accumulatorBits - cls.lutBits
+        if cls.quarterWave:
+            quarter = 2 ** (cls.lutBits - 2)
+            quadrantShift = cls.lutBits - 2
+
+            def entry(index):
+                quadrant = index >> quadrantShift
+                offset = index & (quarter - 1)
+                value = lut[quarter - offset] if quadrant & 1 else lut[offset]
+                return -value if quadrant & 2 else value
+        else:
+            entry = lut.__getitem__
+        if not cls.interpolate:
+            return lambda phase: entry(phase >> truncateBits)
+
+        lutMask = 2 ** cls.lutBits - 1
+        fractionMask = 2 ** truncateBits - 1
+        fractionScale = 1.0 / 2 ** truncateBits
+
+        def sample(phase):
+            index = phase >> truncateBits
+            a, b = entry(index), entry((index + 1) & lutMask)
+            return a + (phase & fractionMask) * fractionScale * (b - a)
+        return sample
+
+    @_ddsMethod
+    def _lookupArray(cls, phases):
+        # Vectorized _sampleLookup(), NumPy array of phases to samples
+        if cls._lutArray is None:
+            dtype = {'d': numpy.float64, 'f': numpy.float32}[cls.lutTypecode]
+            cls._lutArray = numpy.frombuffer(cls.lut, dtype=dtype)
+        table = cls._lutArray
+        truncateBits = cls.accumulatorBits - cls.lutBits
+
+        def entries(index):
+            if not cls.quarterWave:
+                return table[index]
+            quarter = 2 ** (cls.lutBits - 2)
+            quadrant = index >> (cls.lutBits - 2)
+            offset = index & (quarter - 1)
+            values = table[numpy.where(quadrant & 1, quarter - offset, offset)]
+            return numpy.where(quadrant & 2, -values, values)
+
+        index = phases >> truncateBits
+        if not cls.interpolate:
+            return entries(index)
+        a, b = entries(index), entries((index + 1) & (2 ** cls.lutBits - 1))
+        fraction = (phases & (2 ** truncateBits - 1)) * (1.0 / 2 ** truncateBits)
+        return a + fraction * (b - a)
+
+    @_ddsMethod
+    def dds(cls, freqHz, phaseOffsetRad=0, frameRate=None):
         # https://www.allaboutcircuits.com/technical-articles/basics-of-phase-truncation-in-direct-digital-synthesizers/
+        # frameRate defaults to the current sampler.FRAME_RATE
         if cls.lut is None:
             cls.generateLut()
+        if frameRate is None:
+            frameRate = sampler.FRAME_RATE
         accumulatorSize = 2 ** cls.accumulatorBits
 
-        freqNorm = float(freqHz) / sampler.FRAME_RATE  # 1 / samples
+        freqNorm = float(freqHz) / frameRate  # 1 / samples
         deltaPhase = int(round(freqNorm * accumulatorSize))  # accumulatorPhases / sample
 
         logger.debug('[dds][acc] frequency resolution ≈ {} Hz'.format(
-            round(float(sampler.FRAME_RATE) / accumulatorSize, 5)))
+            round(float(frameRate) / accumulatorSize, 5)))
         logger.debug('[dds][acc] phase accumulator will overflow every {} seconds ({} Hz)'.format(
-            round(float(accumulatorSize) / deltaPhase / sampler.FRAME_RATE, 5),
-            round(float(deltaPhase) / accumulatorSize * sampler.FRAME_RATE, 5),
+            round(float(accumulatorSize) / deltaPhase / frameRate, 5),
+            round(float(deltaPhase) / accumulatorSize * frameRate, 5),
             ))
         logger.debug(
-            '[dds][lut] phase truncation spurs ~ {6.08 * cls.lutBits} dB below fundamental')
+            f'[dds][lut] phase truncation spurs ~ {6.08 * cls.lutBits} dB below fundamental')
 
         phaseAccumulator = int(0 + phaseOffsetRad / freqNorm) % accumulatorSize
         truncateBits = cls.accumulatorBits - cls.lutBits
+        if cls.quarterWave or cls.interpolate:
+            sample = cls._sampleLookup()
+            while True:
+                phaseAccumulator += deltaPhase
+                if phaseAccumulator >= accumulatorSize:
+                    phaseAccumulator -= accumulatorSize
+                yield sample(phaseAccumulator)
+        lut = cls.lut
         while True:
             phaseAccumulator += deltaPhase
             if phaseAccumulator >= accumulatorSize:
                 phaseAccumulator -= accumulatorSize
-            yield cls.lut[phaseAccumulator >> truncateBits]
+            yield lut[phaseAccumulator >> truncateBits]
+
+    @_ddsMethod
+    def _accumulator(cls, freqHz, phaseOffsetRad=0):
+        # initial phase accumulator value and phase increment per sample, as in dds()
+        accumulatorSize = 2 ** cls.accumulatorBits
+        freqNorm = float(freqHz) / sampler.FRAME_RATE
+        deltaPhase = int(round(freqNorm * accumulatorSize))
+        phaseAccumulator = int(0 + phaseOffsetRad / freqNorm) % accumulatorSize
+        return phaseAccumulator, deltaPhase
+
+    @_ddsMethod
+    def dds_blocks(cls, freqHz, phaseOffsetRad=0, block_size=None):
+        '''
+        Block generator version of `DDS.dds()`
+
+        Yields blocks of `block_size` samples (default `sampler.BLOCK_SIZE`)
+        identical to the samples produced by `dds()`.
+        '''
+        for oscillators in cls.dds_bank((freqHz,), (phaseOffsetRad,), block_size):
+            yield oscillators[0]
+
+    @_ddsMethod
+    def dds_segment(cls, freqHz, start, count, phaseOffsetRad=0):
+        '''
+        Return `count` samples of `DDS.dds()` from sample `start` as a block
+
+        The phase accumulator value of any sample follows directly from its
+        index, so segments can be rendered in any order.
+        '''
+        if cls.lut is None:
+            cls.generateLut()
+        accumulatorMask = 2 ** cls.accumulatorBits - 1
+        phaseAccumulator, deltaPhase = cls._accumulator(freqHz, phaseOffsetRad)
+        first = (phaseAccumulator + deltaPhase * (start + 1)) & accumulatorMask
+        if numpy_loaded:
+            steps = deltaPhase * numpy.arange(count, dtype=numpy.int64)
+            phases = (first + steps) & accumulatorMask
+            return blocks.from_ndarray(cls._lookupArray(phases))
+        sample = cls._sampleLookup()
+        return array.array('d', [sample((first + deltaPhase * i) & accumulatorMask)
+                                 for i in range(count)])
+
+    @_ddsMethod
+    def dds_bank(cls, frequencies, phaseOffsetsRad=None, block_size=None):
+        '''
+        Render a bank of DDS oscillators together
+
+        Yields a list of blocks per step, one block for each frequency in
+        `frequencies`. `phaseOffsetsRad` optionally gives the starting phase
+        of each oscillator.
+
+        With NumPy installed, the phase accumulators of the whole bank are
+        advanced for a block at a time (accumulator phases, mod
+        2**accumulatorBits, truncated and gathered from the LUT) rather
+        than sample by sample.
+        '''
+        plain = not (cls.quarterWave or cls.interpolate)
+        truncateBits = cls.accumulatorBits - cls.lutBits
+        for phases in cls._bank_phases(frequencies, phaseOffsetsRad, block_size):
+            if numpy_loaded:
+                yield [blocks.from_ndarray(row) for row in cls._lookupArray(phases)]
+            elif plain:
+                lut = cls.lut
+                yield [array.array('d', [lut[phase >> truncateBits] for phase in row])
+                       for row in phases]
+            else:
+                sample = cls._sampleLookup()
+                yield [array.array('d', [sample(phase) for phase in row]) for row in phases]
+
+    @_ddsMethod
+    def dds_bank_sum(cls, frequencies, amplitudes=None, phaseOffsetsRad=None, block_size=None):
+        '''
+        Render a bank of DDS oscillators mixed down to one block generator
+
+        Each oscillator is scaled by the corresponding entry in `amplitudes`
+        (default 1 / len(frequencies)) before summing.
+        '''
+        if amplitudes is None:
+            amplitudes = [1.0 / len(frequencies)] * len(frequencies)
+        if numpy_loaded:
+            weights = numpy.array(amplitudes, dtype=numpy.float64)
+            for phases in cls._bank_phases(frequencies, phaseOffsetsRad, block_size):
+                yield blocks.from_ndarray(weights @ cls._lookupArray(phases))
+        else:
+            for oscillators in cls.dds_bank(frequencies, phaseOffsetsRad, block_size):
+                yield array.array('d', map(
+                    lambda *samples: sum(map(operator.mul, amplitudes, samples)),
+                    *oscillators))
+
+    @_ddsMethod
+    def _bank_phases(cls, frequencies, phaseOffsetsRad=None, block_size=None):
+        # Yields phase accumulator values for each block, one row per oscillator
+        if cls.lut is None:
+            cls.generateLut()
+        if block_size is None:
+            block_size = sampler.BLOCK_SIZE
+        if phaseOffsetsRad is None:
+            phaseOffsetsRad = [0] * len(frequencies)
+        accumulatorMask = 2 ** cls.accumulatorBits - 1
+        starts, deltas = zip(*[cls._accumulator(freqHz, phaseOffsetRad)
+                               for freqHz, phaseOffsetRad in zip(frequencies, phaseOffsetsRad)])
+
+        if numpy_loaded:
+            phaseAccumulators = numpy.array(starts, dtype=numpy.int64)[:, None]
+            deltaPhases = numpy.array(deltas, dtype=numpy.int64)[:, None]
+            # cumulative phase increments for every sample in the block
+            steps = deltaPhases * numpy.arange(1, block_size + 1, dtype=numpy.int64)
+            while True:
+                yield (phaseAccumulators + steps) & accumulatorMask
+                phaseAccumulators = (phaseAccumulators + steps[:, -1:]) & accumulatorMask
+        else:
+            phaseAccumulators = list(starts)
+            while True:
+                yield [[phase & accumulatorMask
+                        for phase in range(phaseAccumulator + deltaPhase,
+                                           phaseAccumulator + deltaPhase * (block_size + 1),
+                                           deltaPhase)]
+                       if deltaPhase != 0 else
+                       [phaseAccumulator] * block_size
+                       for phaseAccumulator, deltaPhase in zip(phaseAccumulators, deltas)]
+                phaseAccumulators = [(phaseAccumulator + block_size * deltaPhase) & accumulatorMask
+                                     for phaseAccumulator, deltaPhase
+                                     in zip(phaseAccumulators, deltas)]
 
 
 def dds(freqHz=440, phaseOffsetRad=0):
     return DDS.dds(freqHz, phaseOffsetRad)
 
 
-def tone(frequency=440, phase_offset=0, min_=-1, max_=1, frame_rate=None):
-    return DDS.dds(frequency)
-
-    if frame_rate is None:
-        frame_rate = sampler.FRAME_RATE
-
-    def fixed_tone(frequency):
-        frequencyHz = float(frequency)
-        periodf = float(frame_rate) / frequency
-        period = int(frame_rate / frequency)
-        time_scale = 2 * math.pi / periodf  # period * scale = 2 * pi
-        # precompute fixed tone samples # TODO: what about phase glitches at end?
-
-        logger.debug('Periodf is {}'.format(periodf))
-
-        def phase_indexes():
-            phase_index_offset = int(phase_offset / time_scale)
-            for i in range(period * 1):
-                phase_index = i + phase_index_offset
-                if phase_index >= period:
-                    phase_index -= period
-                elif phase_index < 0:
-                    phase_index += period
-                yield phase_index
+def dds_blocks(freqHz=440, phaseOffsetRad=0, block_size=None):
+    return DDS.dds_blocks(freqHz, phaseOffsetRad, block_size)
 
-        freqNorm = frequencyHz / frame_rate  # 1 / samples
-        period = 1. / frequency              # seconds
-        periodNorm = 1. / freqNorm           # samples
 
-        # every periodNorm samples we want sin(sample) to cycle;
-        # i.e. sin(periodNorm * cyclesPerSample) = sin(2 * PI)
+def dds_bank(frequencies, phaseOffsetsRad=None, block_size=None):
+    return DDS.dds_bank(frequencies, phaseOffsetsRad, block_size)
 
-        cyclesPerSample = 2 * math.pi / periodNorm  # 1 / samples
 
-        samples = [math.sin(i * cyclesPerSample) for i in range(int(periodNorm * 2))]
-
-        # samples = [math.sin(i * time_scale) for i in phase_indexes()]
-        # samples = [math.sin(i * time_scale) for i in range(int(periodf * 1))]
-        # samples = [math.sin(i * samples_per_second) for i in range(int(periodf * 1))]
+def tone(frequency=440, phase_offset=0, min_=-1, max_=1, frame_rate=None,
+         use_wavetable=False):
+    '''
+    Generate a sine tone
 
-        return itertools.cycle(samples)
+    `frequency` is either a fixed frequency in Hz, or a generator of
+    frequencies for frequency modulated tones. Output is scaled to
+    [`min_`, `max_`]. `frame_rate` defaults to the current
+    `sampler.FRAME_RATE`.
 
+    Fixed frequency tones come from `DDS.dds()` by default. With
+    `use_wavetable=True`, they replay a precomputed table instead, see
+    `wavetable()`. `phase_offset` in radians applies to wavetable and
+    frequency modulated tones.
+    '''
     def variable_tone(frequency):
-        time_scale = TWO_PI / frame_rate
+        time_scale = TWO_PI / (sampler.FRAME_RATE if frame_rate is None else frame_rate)
         phase = phase_offset
         for f in frequency:
             yield math.sin(phase)
 
             phase += time_scale * f
 
-            # don't reset hard to zero – avoids sudden phase glitches due to rounding error
+            # don't reset hard to zero – avoids sudden phase glitches due to rounding error
             if phase > TWO_PI:
                 phase -= TWO_PI
             elif phase < 0:
                 phase += TWO_PI
 
-    if not hasattr(frequency, 'next'):
-        gen = fixed_tone(frequency)
-    else:
+    if hasattr(frequency, '__next__'):
         gen = variable_tone(frequency)
+    elif use_wavetable:
+        gen = itertools.cycle(wavetable(frequency, phase_offset, frame_rate=frame_rate))
+    else:
+        gen = DDS.dds(frequency, frameRate=frame_rate)
+    if (min_, max_) == (-1, 1):
+        return gen
     return util.normalize(gen, -1, 1, min_, max_)
 
 
+# maximum phase error, in cycles, when closing a wavetable's loop
+WAVETABLE_TOLERANCE = 1e-4
+
+
+def _convergents(x):
+    # continued fraction convergents (p, q) of the Fraction x >= 0, p / q -> x
+    p0, q0, p1, q1 = 0, 1, 1, 0
+    while True:
+        whole = x.numerator // x.denominator
+        p0, q0, p1, q1 = p1, q1, whole * p1 + p0, whole * q1 + q0
+        yield p1, q1
+        if x == whole:
+            return
+        x = 1 / (x - whole)
+
+
+def wavetable(frequency, phase_offset=0, tolerance=WAVETABLE_TOLERANCE, frame_rate=None):
+    '''
+    Return one loop of a fixed frequency sine tone as an `array('d')`
+
+    The loop length comes from the continued fraction convergents of the
+    frequency in cycles per sample: the first that holds a whole number
+    of periods to within `tolerance` cycles, or otherwise the closest up
+    to one second, or for tones below 1 Hz one period. The table's
+    frequency is adjusted by the remaining phase error so that it
+    repeats seamlessly. `frequency` must be positive.
+    '''
+    if frame_rate is None:
+        frame_rate = sampler.FRAME_RATE
+    if not frequency > 0:
+        raise ValueError("Wavetable frequency must be positive, got {0}".format(frequency))
+    cyclesPerSample = fractions.Fraction(frequency) / frame_rate
+    best = None
+    for cycles, length in _convergents(cyclesPerSample):
+        if cycles < 1:
+            continue
+        if best is not None and length > frame_rate:
+            break
+        error = float(abs(length * cyclesPerSample - cycles))
+        best = error, length
+        if error <= tolerance:
+            break
+    error, length = best
+    cycles = round(length * cyclesPerSample)
+    phasePerSample = TWO_PI * cycles / length
+    return array.array('d', [math.sin(phasePerSample * i + phase_offset) for i in range(length)])
+
+
+def wavetable_blocks(frequency, phase_offset=0, block_size=None,
+                     tolerance=WAVETABLE_TOLERANCE, frame_rate=None):
+    '''
+    Block generator replaying `wavetable()` for a fixed frequency tone
+
+    Each block is a slice of the table repeated end to end, so steady
+    tones cost little more than a memory copy per block.
+    '''
+    if block_size is None:
+        block_size = sampler.BLOCK_SIZE
+    table = wavetable(frequency, phase_offset, tolerance, frame_rate)
+    # repeat the table to cover a block starting anywhere in the loop
+    tiled = table * (block_size // len(table) + 2)
+    position = 0
+    while True:
+        yield tiled[position:position + block_size]
+        position = (position + block_size) % len(table)
+
+
 def synth(freq, angles):
     if isinstance(angles, (int, float)):
         # argument was just the end angle
@@ -0,0 +1,241 @@
+'''
+Pipeline instrumentation
+
+Opt-in per stage statistics for finding the slow stages of a render:
+
+    with audiogen.instrument.profile() as stats:
+        audiogen.sampler.write_wav(f, channels)
+    print(stats.report())
+
+While a profile is active, the stages audiogen builds (`hard_clip`,
+`normalize`, filters, sample packing, interleaving, the writer...) are
+wrapped to record the items and samples they yield, the blocks among
+them, and the time spent producing them. Time is counted once: a
+stage's `seconds` excludes the time spent in instrumented stages it
+pulls from, while `total_seconds` includes it. Counters record events
+such as clipped samples.
+
+Only stages built inside the `with` block are instrumented, and when no
+profile is active `stage()` returns its input unchanged, so the
+pipeline costs nothing extra. Like the render configuration in
+`audiogen.config`, the active profile is a context variable: a profile
+only sees the stages built in its own thread or asyncio task, and in
+contexts copied from it, such as the renders of `audiogen.streaming`
+and `audiogen.playback`.
+
+Wrap your own stages with `stage()`:
+
+    gen = audiogen.instrument.stage("my_effect", my_effect(gen))
+'''
+
+import time
+import functools
+import threading
+import contextlib
+import contextvars
+import collections
+
+# the active Profile, or None
+_active = contextvars.ContextVar("audiogen_profile", default=None)
+
+_local = threading.local()
+
+
+class StageStats(object):
+    '''Statistics for one named pipeline stage'''
+    def __init__(self, name):
+        self.name = name
+        # instances of the stage built
+        self.instances = 0
+        # items yielded: samples, blocks, Frames or byte strings
+        self.items = 0
+        # audio samples yielded, across all channels
+        self.samples = 0
+        # block, Frames and byte string items among those yielded
+        self.blocks = 0
+        # bytes yielded as byte strings
+        self.bytes = 0
+        # time spent in the stage itself, and including the stages it pulls from
+        self.seconds = 0.0
+        self.total_seconds = 0.0
+
+    def record(self, item):
+        self.items += 1
+        if isinstance(item, (int, float)):
+            self.samples += 1
+        elif isinstance(item, (bytes, bytearray, memoryview)):
+            self.blocks += 1
+            self.bytes += memoryview(item).nbytes
+        elif hasattr(item, "channel_count"):
+            # blocks.Frames
+            self.blocks += 1
+            self.samples += len(item) * item.channel_count
+        elif hasattr(item, "__len__"):
+            self.blocks += 1
+            self.samples += len(item)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in (
+            "name", "instances", "items", "samples", "blocks", "bytes", "seconds",
+            "total_seconds"))
+
+    def __repr__(self):
+        return "StageStats({0!r}, {1} samples, {2} blocks, {3:.6f} s)".format(
+            self.name, self.samples, self.blocks, self.seconds)
+
+
+class Profile(object):
+    '''
+    Statistics collected while active, see `profile()`
+
+    `stages` maps stage names to `StageStats` and `counters` maps counter
+    names to counts, both in the order first seen.
+    '''
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats(name)
+            return stats
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        '''Return the statistics as a dict of plain data, e.g. for logging as JSON'''
+        return dict(stages=[stats.as_dict() for stats in self.stages.values()],
+                    counters=dict(self.counters))
+
+    def report(self):
+        '''Return a text table of the stages, slowest first, and the counters'''
+        total = sum(stats.seconds for stats in self.stages.values()) or 1.0
+        lines = ["{0:<24} {1:>10} {2:>6} {3:>9} {4:>12} {5:>12} {6:>12}".format(
+            "stage", "seconds", "time", "blocks", "samples", "bytes", "samples/s")]
+        for stats in sorted(self.stages.values(), key=lambda s: s.seconds, reverse=True):
+            rate = stats.samples / stats.total_seconds if stats.total_seconds else 0
+            lines.append(
+                "{0:<24} {1:>10.4f} {2:>6.1%} {3:>9,} {4:>12,} {5:>12,} {6:>12,.0f}".format(
+                    stats.name, stats.seconds, stats.seconds / total, stats.blocks,
+                    stats.samples, stats.bytes, rate))
+        for name, count in self.counters.items():
+            lines.append("{0:<24} {1:>10,}".format(name, count))
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def profile(stats=None):
+    '''
+    Instrument the stages built within the `with` block
+
+    Yields the `Profile` collecting the statistics, `stats` if given, to
+    accumulate several renders into one report.
+    '''
+    stats = Profile() if stats is None else stats
+    token = _active.set(stats)
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+
+
+def current():
+    '''Return the active `Profile`, or None'''
+    return _active.get()
+
+
+def _stack():
+    # Per thread stack of the time spent in nested stages
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _timed(stats, iterable):
+    iterator = iter(iterable)
+    clock = time.perf_counter
+    while True:
+        stack = _stack()
+        stack.append(0.0)
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed = clock() - start
+            stats.total_seconds += elapsed
+            stats.seconds += elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+        stats.record(item)
+        yield item
+
+
+def stage(name, iterable):
+    '''
+    Return `iterable` instrumented as stage `name` if a profile is active
+
+    Returns `iterable` itself otherwise.
+    '''
+    active = _active.get()
+    if active is None:
+        return iterable
+    stats = active.stage(name)
+    stats.instances += 1
+    return _timed(stats, iterable)
+
+
+def instrumented(name):
+    '''
+    Decorator instrumenting the iterables a function returns as stage `name`
+
+    See `stage()`.
+    '''
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            return stage(name, f(*args, **kwargs))
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def timed(name, item=None):
+    '''
+    Count the time spent in the `with` block towards stage `name`, if profiling
+
+    `item`, if given, is recorded as yielded by the stage, e.g. the chunk a
+    sink writes.
+    '''
+    active = _active.get()
+    if active is None:
+        yield
+        return
+    stats = active.stage(name)
+    if item is not None:
+        stats.record(item)
+    stack = _stack()
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.total_seconds += elapsed
+        stats.seconds += elapsed - stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+
+def count(name, n=1):
+    '''Add `n` to counter `name`, if profiling'''
+    active = _active.get()
+    if active is not None:
+        active.count(name, n)
@@ -1,7 +1,20 @@
 
 import logging
 
+import math
+import array
+import hashlib
+
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
 import audiogen.util as util
+import audiogen.blocks as blocks
+import audiogen.filters as filters
+import audiogen.sampler as sampler
 
 logger = logging.getLogger(__name__)
 
@@ -14,11 +27,11 @@ def arcfour(key, csbN=1):
        key provided. Keys should be byte strings or sequences of ints.'''
     if isinstance(key, str):
         key = [ord(c) for c in key]
-    s = range(256)
+    s = list(range(256))
     j = 0
     for n in range(csbN):
         for i in range(256):
-            j = (j + s[i] + key[i % len(key)]) % 255
+            j = (j + s[i] + key[i % len(key)]) & 255
             s[i], s[j] = s[j], s[i]
     i, j = 0, 0
     while True:
@@ -51,12 +64,11 @@ def white_noise(key=(1, 2, 3, 4, 5)):
 
 
 def white_noise_samples(key=(1, 2, 3, 4, 5)):
-    '''Provides 16 bit raw integer samples as strs directly from random number generator'''
+    '''Provides 16 bit raw integer samples as bytes directly from random number generator'''
     af = arcfour(key)
     while True:
         # extract 16 bits of randomness per sample
-        # since chr() produces strs, + concatenates the two bytes
-        yield chr(next(af)) + chr(next(af))
+        yield bytes((next(af), next(af)))
 
 
 def red_noise(key=(1, 2, 3, 4, 5)):
@@ -92,6 +104,226 @@ def red_noise(key=(1, 2, 3, 4, 5)):
     return random_walk(key, dynamic_range)
 
 
+# Counter based noise
+#
+# Philox4x64-10 (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3")
+# maps a 128 bit key and a counter to four 64 bit random words, so the noise
+# at any sample offset can be computed directly. Sample n is the (n % 4)th
+# word for counter n // 4 + 1, matching NumPy's Philox bit generator, which
+# is used when available.
+
+PHILOX_M0 = 0xD2E7470EE14C6C93
+PHILOX_M1 = 0xCA5A826395121157
+PHILOX_W0 = 0x9E3779B97F4A7C15
+PHILOX_W1 = 0xBB67AE8584CAA73B
+MASK_64 = 2**64 - 1
+
+
+def philox_key(key):
+    '''Derive a 128 bit Philox key, as two 64 bit words, from a noise key'''
+    if isinstance(key, str):
+        data = key.encode('utf-8')
+    elif isinstance(key, int):
+        data = key.to_bytes((key.bit_length() + 8) // 8, 'little', signed=True)
+    else:
+        data = bytes(key)
+    digest = hashlib.sha256(data).digest()
+    return (int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:16], 'little'))
+
+
+def philox(counter, key):
+    '''Return the four 64 bit Philox4x64-10 words for `counter` and two word `key`'''
+    c0, c1, c2, c3 = counter & MASK_64, (counter >> 64) & MASK_64, 0, 0
+    k0, k1 = key
+    for r in range(10):
+        if r:
+            k0 = (k0 + PHILOX_W0) & MASK_64
+            k1 = (k1 + PHILOX_W1) & MASK_64
+        p0 = PHILOX_M0 * c0
+        p1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = (p1 >> 64) ^ c1 ^ k0, p1 & MASK_64, (p0 >> 64) ^ c3 ^ k1, p0 & MASK_64
+    return c0, c1, c2, c3
+
+
+def white_noise_segment(key=(1, 2, 3, 4, 5), start=0, count=None):
+    '''
+    Return `count` samples of keyed white noise starting at sample `start`
+
+    Samples are uniformly distributed in [-1, 1). Any segment can be
+    computed directly, in O(1) time for the offset, and always matches
+    the same span of `white_noise_blocks()` for the key.
+    '''
+    if count is None:
+        count = sampler.BLOCK_SIZE
+    words = philox_key(key)
+    if numpy_loaded:
+        bitGenerator = numpy.random.Philox(key=numpy.array(words, dtype=numpy.uint64))
+        bitGenerator.advance(start // 4)
+        raw = bitGenerator.random_raw(start % 4 + count)[start % 4:]
+        # top 53 bits as a float in [0, 1), then scale to [-1, 1)
+        return blocks.from_ndarray((raw >> 11) * (2.0 ** -52) - 1)
+    raw = []
+    for counter in range(start // 4 + 1, (start + count - 1) // 4 + 2):
+        raw.extend(philox(counter, words))
+    return array.array('d', [(r >> 11) * (2.0 ** -52) - 1
+                             for r in raw[start % 4:start % 4 + count]])
+
+
+def white_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None):
+    '''Block generator of keyed white noise, beginning at sample `start`'''
+    if block_size is None:
+        block_size = sampler.BLOCK_SIZE
+    while True:
+        yield white_noise_segment(key, start, block_size)
+        start += block_size
+
+
+# red noise leaky integrator pole, ~10 Hz at 44.1 kHz
+RED_NOISE_DECAY = 0.9985
+
+
+def red_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None, decay=RED_NOISE_DECAY):
+    '''
+    Block generator of keyed red (Brownian) noise, beginning at sample `start`
+
+    Integrates `white_noise_blocks()` with a leaky integrator, scaled to an
+    RMS level of 0.25 and clipped to [-1, 1]. Rendering from a later
+    `start` warms the integrator up on the preceding noise until its
+    state has converged, so segments line up with a render from zero to
+    within 1e-9.
+    '''
+    if block_size is None:
+        block_size = sampler.BLOCK_SIZE
+    # uniform white noise has variance 1/3
+    scale = 0.25 / math.sqrt((1 - decay) / (1 + decay) / 3)
+    integrator = filters.BlockIIR([(1 - decay) * scale], [decay])
+    warmup = min(start, int(math.ceil(math.log(1e-9) / math.log(decay))))
+    if warmup:
+        integrator(white_noise_segment(key, start - warmup, warmup))
+    for block in white_noise_blocks(key, start, block_size):
+        yield array.array('d', [max(-1., min(1., sample)) for sample in integrator(block)])
+
+
+# Colored noise
+#
+# Colored noises shape keyed white noise with a long linear phase FIR filter
+# whose magnitude response follows the color's power spectral density slope,
+# applied by FFT convolution. Each output sample depends only on a fixed
+# window of the white noise, so colored noise is seekable too.
+
+# power spectral density exponent, i.e. PSD ~ f ** exponent
+NOISE_COLORS = {
+    'white': 0,
+    'pink': -1,
+    'brown': -2,
+    'blue': 1,
+    'violet': 2,
+}
+
+# FIR length; the spectral slope flattens out below ~FRAME_RATE / NOISE_FILTER_TAPS
+NOISE_FILTER_TAPS = 4096
+
+noise_filter_cache = {}
+
+
+def noise_filter(color, taps=NOISE_FILTER_TAPS):
+    '''
+    Return the FIR filter shaping white noise into `color` noise
+
+    Scaled so that uniform white noise in [-1, 1) comes out with an RMS
+    level of 0.25. Requires NumPy.
+    '''
+    key = color, taps
+    if key not in noise_filter_cache:
+        exponent = NOISE_COLORS[color]
+        frequencies = numpy.fft.rfftfreq(taps)
+        gain = numpy.zeros(len(frequencies))
+        gain[1:] = frequencies[1:] ** (exponent / 2.)
+        # zero phase response, centered and windowed to a linear phase FIR
+        h = numpy.roll(numpy.fft.irfft(gain, taps), taps // 2) * numpy.hanning(taps)
+        # white noise has variance 1/3
+        h *= 0.25 / numpy.sqrt(numpy.sum(h ** 2) / 3)
+        noise_filter_cache[key] = h
+    return noise_filter_cache[key]
+
+
+def colored_noise_segment(color, key=(1, 2, 3, 4, 5), start=0, count=None,
+                          taps=NOISE_FILTER_TAPS):
+    '''
+    Return `count` samples of keyed `color` noise starting at sample `start`
+
+    `color` is one of NOISE_COLORS. Output is clipped to [-1, 1].
+    Requires NumPy.
+    '''
+    if not numpy_loaded:
+        raise Exception("Colored noise requires NumPy. Install with `pip install numpy`.")
+    if count is None:
+        count = sampler.BLOCK_SIZE
+    h = noise_filter(color, taps)
+    white = blocks.as_ndarray(white_noise_segment(key, start, count + taps - 1))
+    size = 1 << (len(white) + taps - 2).bit_length()
+    shaped = numpy.fft.irfft(numpy.fft.rfft(white, size) * numpy.fft.rfft(h, size), size)
+    return blocks.from_ndarray(numpy.clip(shaped[taps - 1:taps - 1 + count], -1, 1))
+
+
+def colored_noise_blocks(color, key=(1, 2, 3, 4, 5), start=0, block_size=None,
+                         taps=NOISE_FILTER_TAPS):
+    '''Block generator of keyed `color` noise, beginning at sample `start`. Requires NumPy.'''
+    # render several filter lengths at a time to amortize the FFT overlap
+    segment = 4 * taps
+
+    def segments(start):
+        while True:
+            yield colored_noise_segment(color, key, start, segment, taps)
+            start += segment
+    return blocks.rechunk(segments(start), block_size)
+
+
+def pink_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None):
+    '''Block generator of keyed pink (1/f) noise. Requires NumPy.'''
+    return colored_noise_blocks('pink', key, start, block_size)
+
+
+def brown_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None):
+    '''Block generator of keyed brown (1/f**2) noise. Requires NumPy.'''
+    return colored_noise_blocks('brown', key, start, block_size)
+
+
+def blue_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None):
+    '''Block generator of keyed blue (f) noise. Requires NumPy.'''
+    return colored_noise_blocks('blue', key, start, block_size)
+
+
+def violet_noise_blocks(key=(1, 2, 3, 4, 5), start=0, block_size=None):
+    '''Block generator of keyed violet (f**2) noise. Requires NumPy.'''
+    return colored_noise_blocks('violet', key, start, block_size)
+
+
+def colored_noise(color, key=(1, 2, 3, 4, 5), start=0, taps=NOISE_FILTER_TAPS):
+    '''Per-sample generator version of `colored_noise_blocks()`. Requires NumPy.'''
+    return blocks.to_samples(colored_noise_blocks(color, key, start, taps=taps))
+
+
+def pink_noise(key=(1, 2, 3, 4, 5), start=0):
+    '''Generator of keyed pink (1/f) noise samples. Requires NumPy.'''
+    return colored_noise('pink', key, start)
+
+
+def brown_noise(key=(1, 2, 3, 4, 5), start=0):
+    '''Generator of keyed brown (1/f**2) noise samples. Requires NumPy.'''
+    return colored_noise('brown', key, start)
+
+
+def blue_noise(key=(1, 2, 3, 4, 5), start=0):
+    '''Generator of keyed blue (f) noise samples. Requires NumPy.'''
+    return colored_noise('blue', key, start)
+
+
+def violet_noise(key=(1, 2, 3, 4, 5), start=0):
+    '''Generator of keyed violet (f**2) noise samples. Requires NumPy.'''
+    return colored_noise('violet', key, start)
+
+
 '''
 RFC 6229
 2.  Test Vectors for RC4
@@ -0,0 +1,180 @@
+'''
+Parallel rendering
+
+Renders the channels of one output in separate worker processes, so that
+a multichannel render can use more than one CPU core. Seekable sources
+(see `audiogen.seekable`) can instead be split into time segments,
+rendered by any number of workers.
+
+Generators can't be sent to another process, so channels are passed as
+picklable zero-argument callables returning the channel's generator,
+e.g. `functools.partial(audiogen.tone, 440)` or a module level function.
+Each worker encodes its channel to PCM and hands chunks of it back
+through shared memory; chunks are reassembled in order before writing.
+'''
+
+import os
+import array
+import logging
+import collections
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+import audiogen.blocks as blocks
+import audiogen.config as config
+import audiogen.sampler as sampler
+
+logger = logging.getLogger(__name__)
+
+# PCM chunks in flight per channel, bounding memory use when the writer
+# or another channel falls behind
+QUEUE_CHUNKS = 4
+
+# length of the time segments rendered by each task
+SEGMENT_SECONDS = 10
+
+
+def _render_channel(factory, queue, stop, render_config, sample_width, chunk_size, blocks_):
+    # Worker process: render one channel into shared memory PCM chunks
+    try:
+        with config.using(render_config):
+            source = factory()
+            if blocks_:
+                source = blocks.rechunk(source, chunk_size)
+            else:
+                source = blocks.from_samples(source, chunk_size)
+            for chunk in sampler.wav_blocks(source, sample_width):
+                chunk = memoryview(chunk).cast('B')
+                shm = shared_memory.SharedMemory(create=True, size=max(1, len(chunk)))
+                shm.buf[:len(chunk)] = chunk
+                queue.put((shm.name, len(chunk)))
+                shm.close()
+                if stop.is_set():
+                    break
+    finally:
+        queue.put(None)
+
+
+def _receive(queue, sample_width):
+    # Yield the PCM chunks of one channel as integer sample arrays
+    typecode = sampler._integer_typecode(sample_width)
+    while True:
+        message = queue.get()
+        if message is None:
+            return
+        name, size = message
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            samples = array.array(typecode)
+            samples.frombytes(shm.buf[:size])
+        finally:
+            shm.close()
+            shm.unlink()
+        yield samples
+
+
+def _discard(queue):
+    # Release the chunks of a channel that is no longer read
+    for samples in _receive(queue, 1):
+        pass
+
+
+def wav_chunks(factories, sample_width=None, blocks_=False, chunk_size=None):
+    '''
+    Render channels in worker processes, yielding interleaved PCM chunks
+
+    `factories` are picklable callables, one per channel, each returning
+    a sample generator (or a block generator if `blocks_` is True). Each
+    channel gets its own process. Yields little endian frames of
+    `chunk_size` samples per channel (default `sampler.BUFFER_SIZE`),
+    ending with the shortest channel.
+    '''
+    if sample_width is None:
+        sample_width = sampler.SAMPLE_WIDTH
+    if chunk_size is None:
+        chunk_size = sampler.BUFFER_SIZE
+    # share one tracker with the workers, which create the shared memory
+    # that is unlinked here
+    resource_tracker.ensure_running()
+    with multiprocessing.Manager() as manager, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=len(factories)) as executor:
+        stop = manager.Event()
+        queues = [manager.Queue(QUEUE_CHUNKS) for factory in factories]
+        futures = [executor.submit(_render_channel, factory, queue, stop, config.current(),
+                                   sample_width, chunk_size, blocks_)
+                   for factory, queue in zip(factories, queues)]
+        channels = [_receive(queue, sample_width) for queue in queues]
+        try:
+            yield from sampler.interleave_blocks(channels, byteswap=False)
+        finally:
+            stop.set()
+            for channel, queue in zip(channels, queues):
+                # drain unfinished channels so their workers can exit
+                if channel.gi_frame is not None:
+                    channel.close()
+                    _discard(queue)
+        for future in futures:
+            # re-raise errors from the workers
+            future.result()
+
+
+def _render_segment(sources, start, count, render_config, sample_width):
+    # Worker process: render one time segment of every channel as
+    # interleaved PCM in shared memory
+    with config.using(render_config):
+        channels = [iter([source.render(start, count)]) for source in sources]
+        pcm = b"".join(sampler.wav_blocks(channels, sample_width))
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(pcm)))
+    shm.buf[:len(pcm)] = pcm
+    shm.close()
+    return shm.name, len(pcm)
+
+
+def wav_segments(sources, sample_width=None, workers=None, segment_size=None):
+    '''
+    Render seekable sources in time segments, yielding interleaved PCM chunks
+
+    `sources` are seekable sources, one per channel. Segments of
+    `segment_size` samples (default `SEGMENT_SECONDS` seconds) are rendered
+    by `workers` processes (default one per CPU) and yielded in order.
+    Output ends with the shortest source.
+    '''
+    if sample_width is None:
+        sample_width = sampler.SAMPLE_WIDTH
+    if segment_size is None:
+        segment_size = int(SEGMENT_SECONDS * sampler.FRAME_RATE)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    lengths = [source.length for source in sources if source.length is not None]
+    length = min(lengths) if lengths else None
+    resource_tracker.ensure_running()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a couple of segments per worker in flight
+        window = 2 * workers
+        pending = collections.deque()
+        start = 0
+        try:
+            while True:
+                while len(pending) < window and (length is None or start < length):
+                    count = segment_size if length is None else min(segment_size, length - start)
+                    pending.append(executor.submit(_render_segment, sources, start, count,
+                                                   config.current(), sample_width))
+                    start += count
+                if not pending:
+                    return
+                name, size = pending.popleft().result()
+                shm = shared_memory.SharedMemory(name=name)
+                try:
+                    yield bytes(shm.buf[:size])
+                finally:
+                    shm.close()
+                    shm.unlink()
+        finally:
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                # release segments that were rendered but not written
+                if not future.cancelled() and future.exception() is None:
+                    shared_memory.SharedMemory(name=future.result()[0]).unlink()
@@ -0,0 +1,309 @@
+'''
+Real-time playback
+
+A `Player` renders audio on a producer thread into a ring buffer, ahead
+of the output device. The device pulls fixed size periods of audio from
+the ring buffer, which costs no more than a memory copy, so a slow
+render stage shows up as an underrun (counted in `Player.underruns`, and
+played as silence) rather than stalling the audio callback.
+
+Output devices are `PyAudioDevice`, for the system soundcard, and
+`NullDevice` and `FileDevice`, which pull audio at the same pace without
+a soundcard, e.g. for testing.
+'''
+
+import time
+import logging
+import threading
+import contextvars
+
+try:
+    import pyaudio
+    pyaudio_loaded = True
+except ImportError:
+    pyaudio_loaded = False
+
+import audiogen.sampler as sampler
+from .wavfile import WavWriter
+
+logger = logging.getLogger(__name__)
+
+# default seconds of audio buffered ahead of the output device
+LATENCY = 0.1
+
+# default output device periods per latency
+PERIODS = 4
+
+
+class RingBuffer(object):
+    '''
+    Single producer, single consumer byte ring buffer of `size` bytes
+
+    One thread may `write()` while another `read_into()`s without locking:
+    each side only advances its own position, and reads the other's.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.view = memoryview(bytearray(size))
+        # total bytes written and read so far
+        self.write_position = 0
+        self.read_position = 0
+
+    def readable(self):
+        return self.write_position - self.read_position
+
+    def writable(self):
+        return self.size - self.readable()
+
+    def write(self, data):
+        '''Write as much of bytes-like `data` as fits, returning the number of bytes written'''
+        data = memoryview(data).cast('B')
+        count = min(len(data), self.writable())
+        start = self.write_position % self.size
+        first = min(count, self.size - start)
+        self.view[start:start + first] = data[:first]
+        self.view[:count - first] = data[first:count]
+        self.write_position += count
+        return count
+
+    def read_into(self, out, count):
+        '''Copy up to `count` bytes into writable buffer `out`, returning the number copied'''
+        count = min(count, self.readable())
+        start = self.read_position % self.size
+        first = min(count, self.size - start)
+        out[:first] = self.view[start:start + first]
+        out[first:count] = self.view[:count - first]
+        self.read_position += count
+        return count
+
+
+class Player(object):
+    '''
+    Play `channels` through an output `device`, `PyAudioDevice` by default
+
+    `channels` and the `raw_samples`, `blocks` and `frames` options are as
+    for `sampler.write_wav()`. `latency` is the number of seconds of audio
+    buffered ahead of the device, which pulls it in `periods` parts.
+
+    `underruns` counts the periods the render didn't keep up with, and
+    `underrun_frames` the frames of silence played in their place.
+    '''
+    def __init__(self, channels, device=None, latency=LATENCY, periods=PERIODS,
+                 raw_samples=False, blocks=False, frames=False):
+        self.device = PyAudioDevice() if device is None else device
+        self.sample_width = sampler.SAMPLE_WIDTH
+        self.frame_rate = sampler.FRAME_RATE
+        self.period_frames = max(1, int(latency * self.frame_rate / periods))
+        self.channel_count, self.stream = sampler.wav_stream(
+            channels, self.sample_width, raw_samples, blocks, frames,
+            chunk_size=self.period_frames)
+        self.frame_size = self.channel_count * self.sample_width
+        self.ring = RingBuffer(self.period_frames * periods * self.frame_size)
+
+        # 8 bit wave samples are unsigned, so silence is 0x80
+        self.silence = (b'\x80' if self.sample_width == 1 else b'\x00') \
+            * (self.period_frames * self.frame_size)
+        self.period = bytearray(self.period_frames * self.frame_size)
+        self.underruns = 0
+        self.underrun_frames = 0
+        self.frames_played = 0
+        self.rendered = False
+        self.stopping = False
+        self.error = None
+        # render in the caller's context, for its audiogen.config
+        self.producer = threading.Thread(target=contextvars.copy_context().run,
+                                         args=(self._produce,), daemon=True)
+
+    def _produce(self):
+        # Producer thread: render ahead into the ring buffer
+        try:
+            for chunk in self.stream:
+                chunk = memoryview(chunk).cast('B')
+                while len(chunk) > 0:
+                    if self.stopping:
+                        return
+                    written = self.ring.write(chunk)
+                    chunk = chunk[written:]
+                    if len(chunk) > 0:
+                        # wait for the device to free about half a period
+                        time.sleep(self.period_frames / self.frame_rate / 2)
+        except BaseException as e:
+            logger.exception("Playback render failed")
+            self.error = e
+        finally:
+            self.rendered = True
+
+    def read(self, frame_count, wait=False):
+        '''
+        Return the next `frame_count` frames for the device, or None at the end
+
+        Pads with silence and counts an underrun if the producer has fallen
+        behind, unless `wait` is True, for devices not tied to a clock.
+        '''
+        size = frame_count * self.frame_size
+        while wait and self.ring.readable() < size and not self.rendered:
+            time.sleep(self.period_frames / self.frame_rate / 4)
+        if size > len(self.period):
+            self.period = bytearray(size)
+            self.silence = self.silence[:1] * size
+        rendered = self.rendered
+        count = self.ring.read_into(self.period, size)
+        count -= count % self.frame_size
+        if count == 0 and rendered:
+            return None
+        if count < size and not rendered:
+            self.underruns += 1
+            self.underrun_frames += (size - count) // self.frame_size
+            self.period[count:size] = self.silence[:size - count]
+            count = size
+        self.frames_played += count // self.frame_size
+        return bytes(self.period[:count])
+
+    def start(self):
+        '''Start rendering, then start the device once the ring buffer is full'''
+        self.producer.start()
+        while self.ring.writable() >= self.frame_size * self.period_frames and not self.rendered:
+            time.sleep(self.period_frames / self.frame_rate / 4)
+        self.device.start(self)
+        return self
+
+    def wait(self):
+        '''Block until playback ends'''
+        try:
+            self.device.wait()
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        '''Stop rendering and playback'''
+        self.stopping = True
+        self.device.stop()
+
+    def is_active(self):
+        return self.device.is_active()
+
+    def __repr__(self):
+        return "Player({0} frames played, {1} underruns)".format(
+            self.frames_played, self.underruns)
+
+
+class PyAudioDevice(object):
+    '''The system soundcard, through PyAudio'''
+    def __init__(self):
+        if not pyaudio_loaded:
+            raise Exception(
+                "Soundcard playback requires PyAudio. Install with `pip install pyaudio`.")
+        self.stream = None
+
+    def start(self, player):
+        def callback(in_data, frame_count, time_info, status):
+            data = player.read(frame_count)
+            if data is None:
+                return b"", pyaudio.paComplete
+            return data, pyaudio.paContinue
+
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = self.pyaudio.open(
+            format=self.pyaudio.get_format_from_width(player.sample_width),
+            channels=player.channel_count,
+            rate=player.frame_rate,
+            output=True,
+            frames_per_buffer=player.period_frames,
+            stream_callback=callback,
+        )
+
+    def is_active(self):
+        return self.stream is not None and self.stream.is_active()
+
+    def wait(self):
+        while self.is_active():
+            time.sleep(0.01)
+
+    def stop(self):
+        if self.stream is None:
+            return
+        try:
+            if not self.stream.is_stopped():
+                self.stream.stop_stream()
+            self.stream.close()
+        except Exception:
+            pass
+        self.pyaudio.terminate()
+        self.stream = None
+
+
+class NullDevice(object):
+    '''
+    Output device that discards audio
+
+    Pulls a period at a time on its own thread, in real time if `realtime`
+    is True, or else as fast as the player can render it, without
+    underruns. `data()` is called with each period's bytes.
+    '''
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+        self.thread = None
+        self.stopping = False
+
+    def data(self, data):
+        pass
+
+    def start(self, player):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, args=(player,), daemon=True)
+        self.thread.start()
+
+    def _run(self, player):
+        period = player.period_frames / player.frame_rate
+        deadline = time.monotonic()
+        try:
+            while not self.stopping:
+                data = player.read(player.period_frames, wait=not self.realtime)
+                if data is None:
+                    return
+                self.data(data)
+                if self.realtime:
+                    deadline += period
+                    time.sleep(max(0, deadline - time.monotonic()))
+        finally:
+            self.closed()
+
+    def closed(self):
+        pass
+
+    def is_active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class FileDevice(NullDevice):
+    '''
+    Output device writing what would be played to file `f` in WAVE format
+
+    Pulls audio like `NullDevice`, as fast as possible by default.
+    '''
+    def __init__(self, f, realtime=False):
+        super(FileDevice, self).__init__(realtime)
+        self.f = f
+        self.writer = None
+
+    def start(self, player):
+        self.writer = WavWriter(self.f, player.channel_count, player.sample_width,
+                                player.frame_rate, seekable=sampler.file_is_seekable(self.f))
+        super(FileDevice, self).start(player)
+
+    def data(self, data):
+        self.writer.write(data)
+
+    def closed(self):
+        self.writer.close()
@@ -0,0 +1,227 @@
+'''
+Sample rate conversion
+
+Streaming polyphase resampling of block generators, so that audio
+rendered once at a master rate can be served at other rates:
+
+    with audiogen.config.using(frame_rate=8000):
+        telephony = audiogen.resample.resample_blocks(master.blocks(), 44100)
+        audiogen.sampler.write_wav(f, telephony, blocks=True)
+
+Converting from `from_rate` to `to_rate` upsamples by L and downsamples
+by M, where L / M is `to_rate / from_rate` in lowest terms, through a
+Kaiser windowed sinc low pass filter. Only the L polyphase branches of
+the filter that produce output samples are ever computed. The filter
+tables are designed once per rate ratio and quality setting and cached.
+
+Sources are pulled with `from_rate` as the current frame rate (see
+`audiogen.config`), so generators built lazily render at the source rate.
+'''
+
+import math
+import array
+
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
+import audiogen.blocks as blocks
+import audiogen.config as config
+
+# filter tables keyed on (L, M, zeros, rolloff, beta)
+table_cache = {}
+
+# filter half length, in zero crossings of the sinc at the cutoff
+ZEROS = 16
+# cutoff, as a fraction of the lower of the two Nyquist frequencies
+ROLLOFF = 0.945
+# Kaiser window shape; 8.6 gives about 80 dB of stopband attenuation
+BETA = 8.6
+
+
+def _i0(x):
+    # Modified Bessel function of the first kind, order zero
+    total, term, k = 1.0, 1.0, 1
+    while term > 1e-12 * total:
+        term *= (x / (2.0 * k)) ** 2
+        total += term
+        k += 1
+    return total
+
+
+class Table(object):
+    '''
+    Polyphase filter table for resampling by `up` / `down`
+
+    `phases[p][k]` is tap `p + k * up` of the prototype filter, so that
+    output sample `n` is the dot product of phase `(n * down + delay) % up`
+    with the input samples before and at `(n * down + delay) // up`,
+    latest first. Each phase is normalized to unity gain at DC.
+    '''
+    def __init__(self, up, down, zeros=ZEROS, rolloff=ROLLOFF, beta=BETA):
+        self.up, self.down = up, down
+        # cutoff, in cycles per sample at the upsampled rate
+        cutoff = rolloff * 0.5 / max(up, down)
+        self.taps = int(math.ceil(zeros / cutoff / up))
+        length = self.taps * up
+        # group delay, in samples at the upsampled rate
+        self.delay = (length - 1) // 2
+        window = [_i0(beta * math.sqrt(max(0.0, 1 - (2.0 * j / (length - 1) - 1) ** 2)))
+                  / _i0(beta) for j in range(length)]
+
+        def sinc(x):
+            return 1.0 if x == 0 else math.sin(math.pi * x) / (math.pi * x)
+        prototype = [sinc(2 * cutoff * (j - self.delay)) * w for j, w in enumerate(window)]
+        self.phases = []
+        for p in range(up):
+            phase = prototype[p::up]
+            total = sum(phase)
+            self.phases.append([h / total for h in phase])
+        if numpy_loaded:
+            self.array = numpy.array(self.phases)
+
+
+def table(up, down, zeros=ZEROS, rolloff=ROLLOFF, beta=BETA):
+    '''Return the cached `Table` for resampling by `up` / `down`'''
+    key = up, down, zeros, rolloff, beta
+    cached = table_cache.get(key)
+    if cached is None:
+        cached = table_cache[key] = Table(up, down, zeros, rolloff, beta)
+    return cached
+
+
+def ratio(from_rate, to_rate):
+    '''Return (up, down), the factors of `to_rate / from_rate` in lowest terms'''
+    divisor = math.gcd(int(from_rate), int(to_rate))
+    return int(to_rate) // divisor, int(from_rate) // divisor
+
+
+class Resampler(object):
+    '''
+    Streaming polyphase resampler for blocks of one channel
+
+    Call with each block in turn; returns the block of output samples it
+    completes, which may be empty. `flush()` returns the rest, for an
+    output `ceil(input length * to_rate / from_rate)` samples long,
+    aligned with the input.
+    '''
+    def __init__(self, from_rate, to_rate, zeros=ZEROS, rolloff=ROLLOFF, beta=BETA):
+        self.up, self.down = ratio(from_rate, to_rate)
+        self.table = table(self.up, self.down, zeros, rolloff, beta)
+        # input samples from absolute index self.start on, with the samples
+        # before the first zero padded
+        self.start = -(self.table.taps - 1)
+        self.buffer = array.array('d', bytes(8 * (self.table.taps - 1)))
+        self.received = 0
+        # next output sample
+        self.position = 0
+
+    def __call__(self, block, limit=None):
+        self.buffer.extend(block)
+        self.received += len(block)
+        up, down, delay = self.up, self.down, self.table.delay
+        # outputs whose latest input sample has arrived
+        end = max(self.position, -(-(self.received * up - delay) // down))
+        if limit is not None:
+            end = min(end, limit)
+        if numpy_loaded:
+            output = self._resample_ndarray(end)
+        else:
+            output = self._resample_lists(end)
+        self.position = end
+        # drop the input no later output needs
+        keep = (end * down + delay) // up - self.table.taps + 1 - self.start
+        if keep > 0:
+            del self.buffer[:keep]
+            self.start += keep
+        return output
+
+    def _resample_ndarray(self, end):
+        t = numpy.arange(self.position, end, dtype=numpy.int64) * self.down + self.table.delay
+        latest = t // self.up - self.start
+        windows = latest[:, None] - numpy.arange(self.table.taps)[None, :]
+        samples = blocks.as_ndarray(self.buffer)[windows]
+        return blocks.from_ndarray(numpy.einsum('nk,nk->n', samples,
+                                                self.table.array[t % self.up]))
+
+    def _resample_lists(self, end):
+        output = array.array('d')
+        taps, buffer, phases = self.table.taps, self.buffer, self.table.phases
+        for n in range(self.position, end):
+            t = n * self.down + self.table.delay
+            latest = t // self.up - self.start
+            window = buffer[latest - taps + 1:latest + 1]
+            window.reverse()
+            output.append(sum(h * s for h, s in zip(phases[t % self.up], window)))
+        return output
+
+    def flush(self):
+        '''Return the last output samples, completing the input with silence'''
+        total = -(-self.received * self.up // self.down)
+        if total <= self.position:
+            return array.array('d')
+        # input samples needed for the last output
+        needed = ((total - 1) * self.down + self.table.delay) // self.up + 1
+        return self(blocks.zeros(max(0, needed - self.received)), limit=total)
+
+
+def _pulled(source, rate):
+    # iterate source with `rate` as the current frame rate
+    source = iter(source)
+    while True:
+        with config.using(frame_rate=rate):
+            item = next(source, None)
+        if item is None:
+            return
+        yield item
+
+
+def resample_blocks(source, from_rate, to_rate=None, block_size=None, zeros=ZEROS,
+                    rolloff=ROLLOFF, beta=BETA):
+    '''
+    Resample a block generator from `from_rate` to `to_rate` Hertz
+
+    `to_rate` defaults to the current frame rate. Yields blocks of
+    `block_size` samples (default `sampler.BLOCK_SIZE`). Raise `zeros`
+    for a sharper filter, at a proportional cost.
+    '''
+    if to_rate is None:
+        to_rate = config.current().frame_rate
+    size = blocks._block_size(block_size)
+    if to_rate == from_rate:
+        return blocks.rechunk(_pulled(source, from_rate), size)
+    resampler = Resampler(from_rate, to_rate, zeros, rolloff, beta)
+
+    def resampled():
+        for block in _pulled(source, from_rate):
+            yield resampler(block)
+        yield resampler.flush()
+    return blocks.rechunk((b for b in resampled() if len(b)), size)
+
+
+def resample_frames(frames, from_rate, to_rate=None, block_size=None, zeros=ZEROS,
+                    rolloff=ROLLOFF, beta=BETA):
+    '''`resample_blocks()` for a generator of multichannel `blocks.Frames`'''
+    if to_rate is None:
+        to_rate = config.current().frame_rate
+    size = blocks._block_size(block_size)
+
+    def channel(source):
+        resampler = Resampler(from_rate, to_rate, zeros, rolloff, beta)
+        for block in source:
+            yield resampler(block)
+        yield resampler.flush()
+
+    def resampled():
+        channels = blocks.split(_pulled(frames, from_rate))
+        yield from blocks.lockstep([blocks.rechunk((b for b in channel(c) if len(b)), size)
+                                    for c in channels])
+    return resampled()
+
+
+def resample(generator, from_rate, to_rate=None, **kwargs):
+    '''Per-sample generator version of `resample_blocks()`'''
+    return blocks.to_samples(resample_blocks(blocks.from_samples(generator), from_rate,
+                                             to_rate, **kwargs))
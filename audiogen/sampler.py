@@ -1,59 +1,62 @@
 
 import logging
 
+import sys
+import array
 import struct
-import wave
 import itertools
 
 try:
-    import pyaudio
-    pyaudio_loaded = True
+    import numpy
+    numpy_loaded = True
 except ImportError:
-    pyaudio_loaded = False
+    numpy_loaded = False
 
 import errno
-import contextlib
-
-from io import StringIO
 
 from .util import hard_clip
 from .util import normalize
+from .util import ClipStats
+from .blocks import split
+from .blocks import lockstep
+from .blocks import as_ndarray
+from .blocks import from_samples
+from .blocks import peek_frames
+from .wavfile import WavWriter
+from . import config
+from . import parallel
+from . import instrument
+from . import playback
+from .cache import cache_finite_samples  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
 # Constants
 
-# frame rate in Hertz
-FRAME_RATE = 44100
+# FRAME_RATE (frame rate in Hertz), SAMPLE_WIDTH (sample width in bytes,
+# 2 = 16 bit) and BLOCK_SIZE (samples per block for block generators, see
+# audiogen.blocks) read the current audiogen.config.RenderConfig
+_CONFIG_FIELDS = dict(FRAME_RATE="frame_rate", SAMPLE_WIDTH="sample_width",
+                      BLOCK_SIZE="block_size")
 
-# sample width in bytes, 2 = 16 bit
-SAMPLE_WIDTH = 2
-COMPRESSION_TYPE = 'NONE'
-COMPRESSION_NAME = 'no compression'
 BUFFER_SIZE = 100000
 
 
-class frame_rate(object):
-    def __init__(self, new_frame_rate):
-        global FRAME_RATE
-        self._saved_frame_rate = FRAME_RATE
-        FRAME_RATE = new_frame_rate
+def __getattr__(name):
+    field = _CONFIG_FIELDS.get(name)
+    if field is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    return getattr(config.current(), field)
 
-    def __enter__(self, ):
-        pass
 
-    def __exit__(self, *args, **kwargs):
-        global FRAME_RATE
-        FRAME_RATE = self._saved_frame_rate
+def frame_rate(new_frame_rate):
+    '''Render at `new_frame_rate` within the `with` block, see `audiogen.config`'''
+    return config.using(frame_rate=new_frame_rate)
 
 
-@contextlib.contextmanager
 def sample_width(new_sample_width):
-    global SAMPLE_WIDTH
-    saved_sample_width = SAMPLE_WIDTH
-    SAMPLE_WIDTH = new_sample_width
-    yield
-    SAMPLE_WIDTH = saved_sample_width
+    '''Write `new_sample_width` byte samples within the `with` block, see `audiogen.config`'''
+    return config.using(sample_width=new_sample_width)
 
 
 def file_is_seekable(f):
@@ -74,8 +77,11 @@ def file_is_seekable(f):
     return True
 
 
-def sample(generator, min=-1, max=1, width=SAMPLE_WIDTH):
+@instrument.instrumented("sample")
+def sample(generator, min=-1, max=1, width=None):
     '''Convert audio waveform generator into packed sample generator.'''
+    if width is None:
+        width = config.current().sample_width
     # select signed char, short, or in based on sample width
     fmt = {1: '<B', 2: '<h', 4: '<i'}[width]
     return (struct.pack(fmt, int(sample)) for sample in
@@ -86,11 +92,44 @@ def sample(generator, min=-1, max=1, width=SAMPLE_WIDTH):
 #       for sample in generator)
 
 
+@instrument.instrumented("sample_blocks")
+def sample_blocks(blocks, min=-1, max=1, width=None):
+    '''
+    Convert audio waveform block generator into integer sample block generator
+
+    Yields `array` blocks of signed integers `width` bytes wide (unsigned for
+    8 bit samples, per the WAVE format), clipped to [`min`, `max`] and
+    scaled the same way as `sample()`.
+    '''
+    if width is None:
+        width = config.current().sample_width
+    typecode = _integer_typecode(width)
+    low, high = -2**(width * 8 - 1), 2**(width * 8 - 1) - 1
+    scale = float(high - low) / (max - min)
+    offset = 2**7 if width == 1 else 0
+    stats = ClipStats(min, max)
+    for block in blocks:
+        stats.update(block)
+        clipped = [max if s > max else min if s < min else s for s in block]
+        yield array.array(typecode, [int((s - min) * scale + low) + offset for s in clipped])
+    stats.report()
+
+
+def _integer_typecode(width):
+    '''Return the array typecode for integer samples `width` bytes wide'''
+    signed = width != 1
+    for typecode in ('bhilq' if signed else 'B'):
+        if array.array(typecode).itemsize == width:
+            return typecode
+    raise ValueError("Unsupported sample width {0}".format(width))
+
+
 def sample_all(generators, *args, **kwargs):
     '''Convert list of audio waveform generators into list of packed sample generators.'''
     return [sample(gen, *args, **kwargs) for gen in generators]
 
 
+@instrument.instrumented("interleave")
 def interleave(channels):
     '''
     Interleave samples from multiple channels for wave output
@@ -106,6 +145,37 @@ def interleave(channels):
             break
 
 
+@instrument.instrumented("interleave_blocks")
+def interleave_blocks(channels, byteswap=True):
+    '''
+    Interleave integer sample blocks from multiple channels for wave output
+
+    Accept a list of integer sample block generators, e.g. from
+    `sample_blocks()`, and generate little endian byte strings of
+    interleaved frames, one per block. Pass `byteswap=False` if the blocks
+    already hold little endian data.
+    '''
+    while True:
+        try:
+            blocks = [next(channel) for channel in channels]
+        except StopIteration:
+            return
+        count = min(len(b) for b in blocks)
+        if len(blocks) == 1:
+            frames = blocks[0]
+        else:
+            frames = array.array(blocks[0].typecode,
+                                 bytes(blocks[0].itemsize * count * len(blocks)))
+            for i, b in enumerate(blocks):
+                frames[i::len(blocks)] = b[:count]
+        if byteswap and sys.byteorder == 'big':
+            frames = array.array(frames.typecode, frames)
+            frames.byteswap()
+        yield frames.tobytes()
+        if any(len(b) > count for b in blocks):
+            return
+
+
 def buffer(stream, buffer_size=BUFFER_SIZE):
     '''
     Buffer the generator into byte strings of buffer_size samples
@@ -120,7 +190,7 @@ def buffer(stream, buffer_size=BUFFER_SIZE):
     return iter(lambda: b"".join(itertools.islice(i, buffer_size)), b"")
 
 
-def wav_samples(channels, sample_width=SAMPLE_WIDTH, raw_samples=False):
+def wav_samples(channels, sample_width=None, raw_samples=False):
     if hasattr(channels, "__next__"):
         # if passed one generator, we have one channel
         channels = (channels,)
@@ -132,102 +202,203 @@ def wav_samples(channels, sample_width=SAMPLE_WIDTH, raw_samples=False):
     return interleave(channels)
 
 
-class NonSeekableFileProxy(object):
-    def __init__(self, file_instance):
-        '''Proxy to protect seek and tell methods of non-seekable file objects'''
-        self.f = file_instance
+def wav_blocks(channels, sample_width=None, raw_samples=False):
+    '''
+    Block generator version of `wav_samples()`
 
-    def __getattr__(self, attr):
-        def dummy(*args):
-            logger.debug("Suppressed call to '{0}'".format(attr))
-            return 0
-        if attr in ('seek', 'tell'):
-            return dummy
-        else:
-            return getattr(self.f, attr)
+    `channels` are block generators, see `audiogen.blocks`. Yields
+    bytes-like objects of whole frames, one per block.
+    '''
+    if hasattr(channels, "__next__"):
+        channels = (channels,)
 
+    if raw_samples:
+        return interleave_blocks(channels)
+    if numpy_loaded:
+        return pack_blocks(channels, width=sample_width)
+    return interleave_blocks([sample_blocks(channel, width=sample_width) for channel in channels])
 
-def wave_module_patched():
-    '''True if wave module can write data size of 0xFFFFFFFF, False otherwise.'''
-    f = StringIO()
-    w = wave.open(f, "wb")
-    w.setparams((1, 2, 44100, 0, "NONE", "no compression"))
-    patched = True
-    try:
-        w.setnframes((0xFFFFFFFF - 36) / w.getnchannels() / w.getsampwidth())
-        w._ensure_header_written(0)
-    except struct.error:
-        patched = False
-        logger.info("Error setting wave data size to 0xFFFFFFFF; "
-                    "wave module unpatched, setting sata size to 0x7FFFFFFF")
-        w.setnframes((0x7FFFFFFF - 36) / w.getnchannels() / w.getsampwidth())
-        w._ensure_header_written(0)
-    return patched
 
+def pack_blocks(channels, min_=-1, max_=1, width=None):
+    '''
+    Clip, scale, convert and interleave block generators into wave frames
 
-def write_wav(f, channels, sample_width=SAMPLE_WIDTH, raw_samples=False, seekable=None):
-    stream = wav_samples(channels, sample_width, raw_samples)
-    channel_count = 1 if hasattr(channels, "__next__") else len(channels)
+    Equivalent to `interleave_blocks()` of `sample_blocks()`, but with
+    NumPy processes each block of every channel at once. Yields a
+    bytes-like object of little endian frames per block.
+    '''
+    return pack_frames(lockstep(channels), min_, max_, width)
 
-    output_seekable = file_is_seekable(f) if seekable is None else seekable
 
-    if not output_seekable:
-        # protect the non-seekable file, since Wave_write will call tell
-        f = NonSeekableFileProxy(f)
-
-    w = wave.open(f)
-    w.setparams((
-        channel_count,
-        sample_width,
-        FRAME_RATE,
-        0,  # setting zero frames, should update automatically as more frames written
-        COMPRESSION_TYPE,
-        COMPRESSION_NAME
-        ))
-
-    if not output_seekable:
-        if wave_module_patched():
-            # set nframes to make wave module write data size of 0xFFFFFFF
-            w.setnframes((0xFFFFFFFF - 36) / w.getnchannels() / w.getsampwidth())
-            logger.debug("Setting frames to: {0}, {1}".format((w.getnframes()), w._nframes))
-        else:
-            w.setnframes((0x7FFFFFFF - 36) / w.getnchannels() / w.getsampwidth())
-            logger.debug("Setting frames to: {0}, {1}".format((w.getnframes()), w._nframes))
+@instrument.instrumented("pack_frames")
+def pack_frames(frames, min_=-1, max_=1, width=None):
+    '''
+    `pack_blocks()` for a generator of multichannel `blocks.Frames`
 
-    for chunk in buffer(stream):
-        logger.debug("Writing %d bytes..." % len(chunk))
-        if output_seekable:
-            w.writeframes(chunk)
-        else:
-            # tell wave module not to update nframes header field
-            # if output stream not seekable, e.g. STDOUT to a pipe
-            w.writeframesraw(chunk)
-    w.close()
+    Yields a bytes-like object of little endian frames per `Frames`.
+    '''
+    if width is None:
+        width = config.current().sample_width
+    if not numpy_loaded:
+        return _pack_lists(frames, min_, max_, width)
+    return _pack_ndarray(frames, min_, max_, width)
+
+
+def _pack_lists(frames, min_, max_, width):
+    # pack each channel on its own, then interleave
+    yield from interleave_blocks([sample_blocks(channel, min_, max_, width)
+                                  for channel in split(frames)])
+
+
+def _pack_ndarray(frames, min_, max_, width):
+    dtype = {1: numpy.int8, 2: '<i2', 4: '<i4'}[width]
+    low, high = -2**(width * 8 - 1), 2**(width * 8 - 1) - 1
+    scale = float(high - low) / (max_ - min_)
+    stats = ClipStats(min_, max_)
+    for frame in frames:
+        data = numpy.empty((len(frame), frame.channel_count))
+        for i, b in enumerate(frame.channels):
+            data[:, i] = as_ndarray(b)
+        clipCount = stats.count
+        stats.update(data)
+        if stats.count > clipCount:
+            numpy.clip(data, min_, max_, out=data)
+        data -= min_
+        data *= scale
+        data += low
+        # astype() truncates towards zero, like int() in sample()
+        samples = data.astype(dtype)
+        if width == 1:
+            # 8 bit wave samples are unsigned
+            samples = (samples.view(numpy.uint8) ^ 0x80)
+        yield memoryview(samples).cast('B')
+    stats.report()
+
+
+def wav_frames(frames, sample_width=None):
+    '''
+    `wav_blocks()` for a generator of multichannel `blocks.Frames`
 
+    Yields bytes-like objects of whole frames, one per `Frames`.
+    '''
+    return pack_frames(frames, width=sample_width)
 
-def cache_finite_samples(f):
-    '''Decorator to cache audio samples produced by the wrapped generator.'''
-    cache = {}
 
-    def wrap(*args):
-        key = FRAME_RATE, args
-        if key not in cache:
-            cache[key] = [sample for sample in f(*args)]
-        return (sample for sample in cache[key])
-    return wrap
+def _cached_pcm(channels, sample_width):
+    # True if every channel is a cache.PcmRender (or alike) of sample_width PCM
+    if hasattr(channels, "__next__"):
+        channels = (channels,)
+    return all(getattr(channel, "pcm", None) is not None
+               and channel.sample_width == sample_width for channel in channels)
 
 
-def _pyaudio_callback(wavgen):
-    def cb(a, frame_count, b, c):
-        data = bytearray()
-        try:
-            for i in range(frame_count):
-                data.extend(next(wavgen))
-        except StopIteration:
-            if len(data) == 0:
-                return b"", pyaudio.paComplete
-        return str(data), pyaudio.paContinue
-    return cb
+def _pcm_stream(channels, sample_width):
+    # Interleave the PCM of each channel into chunks of BUFFER_SIZE frames
+    if hasattr(channels, "__next__"):
+        channels = (channels,)
+    chunk = BUFFER_SIZE * sample_width
+    if len(channels) == 1:
+        pcm = channels[0].pcm
+        for start in range(0, len(pcm), chunk):
+            yield pcm[start:start + chunk]
+        return
+
+    def channel_blocks(pcm):
+        for start in range(0, len(pcm), chunk):
+            samples = array.array(_integer_typecode(sample_width))
+            samples.frombytes(pcm[start:start + chunk])
+            yield samples
+    yield from interleave_blocks([channel_blocks(channel.pcm) for channel in channels],
+                                 byteswap=False)
+
+
+def wav_stream(channels, sample_width=None, raw_samples=False, blocks=False, frames=False,
+               processes=False, workers=None, chunk_size=None):
+    '''
+    Return the channel count and a generator of wave data chunks for `channels`
+
+    Takes `channels` and the options that select how to render them as
+    `write_wav()` does. Chunks are bytes-like objects of whole little
+    endian frames; per-sample generators are packed `chunk_size` frames
+    (default `BUFFER_SIZE`) at a time.
+    '''
+    if sample_width is None:
+        sample_width = config.current().sample_width
+    if chunk_size is None:
+        chunk_size = BUFFER_SIZE
+    if frames:
+        first, frames = peek_frames(channels)
+        return (first.channel_count if first is not None else 1,
+                wav_frames(instrument.stage("source", frames), sample_width))
+    if workers is not None:
+        if hasattr(channels, "render"):
+            channels = (channels,)
+        stream = parallel.wav_segments(channels, sample_width, workers)
+    elif processes:
+        if raw_samples:
+            raise ValueError("Parallel rendering doesn't support raw samples")
+        if callable(channels):
+            channels = (channels,)
+        stream = parallel.wav_chunks(channels, sample_width, blocks)
+    elif blocks:
+        if hasattr(channels, "__next__"):
+            channels = (channels,)
+        stream = wav_blocks([instrument.stage("source", channel) for channel in channels],
+                            sample_width, raw_samples)
+    elif not raw_samples and _cached_pcm(channels, sample_width):
+        # already encoded, e.g. a cache.PcmRender
+        stream = _pcm_stream(channels, sample_width)
+    elif not raw_samples:
+        # pack large blocks of the sample generators at a time
+        if hasattr(channels, "__next__"):
+            channels = (channels,)
+        # seekable sources render large blocks directly
+        stream = wav_blocks([instrument.stage("source", channel.blocks(block_size=chunk_size)
+                                              if hasattr(channel, "render")
+                                              else from_samples(channel, chunk_size))
+                             for channel in channels], sample_width)
+    else:
+        stream = buffer(wav_samples(channels, sample_width, raw_samples), chunk_size)
+    return 1 if hasattr(channels, "__next__") else len(channels), stream
+
+
+def write_wav(f, channels, sample_width=None, raw_samples=False, seekable=None,
+              blocks=False, processes=False, workers=None, frames=False):
+    '''
+    Write `channels` to file `f` in WAVE format
+
+    `channels` is one generator or a list of generators, one per channel.
+    If `blocks` is True, they are block generators (see `audiogen.blocks`)
+    rather than per-sample generators. If `frames` is True, `channels` is
+    instead one generator of multichannel `blocks.Frames`.
+
+    Files larger than 4 GiB are written as RF64 when `f` is seekable. If
+    `f` is not seekable, e.g. STDOUT to a pipe, the header claims the
+    maximum data size, see `audiogen.wavfile`.
+
+    If `processes` is True, each channel is rendered in its own worker
+    process. `channels` are then picklable callables returning the
+    channel generators, see `audiogen.parallel`.
+
+    If `workers` is given, `channels` are seekable sources (see
+    `audiogen.seekable`), rendered in time segments by `workers` worker
+    processes.
+    '''
+    if sample_width is None:
+        sample_width = config.current().sample_width
+    channel_count, stream = wav_stream(channels, sample_width, raw_samples, blocks, frames,
+                                       processes, workers)
+
+    # write bytes to text streams such as sys.stdout
+    f = getattr(f, "buffer", f)
+    output_seekable = file_is_seekable(f) if seekable is None else seekable
+
+    with WavWriter(f, channel_count, sample_width, config.current().frame_rate,
+                   seekable=output_seekable) as w:
+        for chunk in stream:
+            logger.debug("Writing %d bytes..." % len(chunk))
+            with instrument.timed("write", chunk):
+                w.write(chunk)
 
 
 def discard(channels):
@@ -241,38 +412,27 @@ def discard(channels):
         pass
 
 
-def play(channels, blocking=True, raw_samples=False):
+def play(channels, blocking=True, raw_samples=False, frames=False, blocks=False,
+         latency=None, device=None):
     '''
     Play the contents of the generator using PyAudio
 
     Play to the system soundcard using PyAudio. PyAudio, an otherwise optional
     depenency, must be installed for this feature to work.
+
+    `channels` and the `raw_samples`, `blocks` and `frames` options are as
+    for `write_wav()`. Audio is rendered `latency` seconds ahead of the
+    soundcard on a separate thread, see `audiogen.playback`. Pass another
+    output `device`, e.g. `playback.NullDevice()`, to play without a
+    soundcard.
+
+    Returns the `playback.Player`, once playback ends if `blocking`, or
+    else right away.
     '''
-    if not pyaudio_loaded:
-        raise Exception("Soundcard playback requires PyAudio. Install with `pip install pyaudio`.")
-
-    channel_count = 1 if hasattr(channels, "__next__") else len(channels)
-    wavgen = wav_samples(channels, raw_samples=raw_samples)
-    p = pyaudio.PyAudio()
-    stream = p.open(
-        format=p.get_format_from_width(SAMPLE_WIDTH),
-        channels=channel_count,
-        rate=FRAME_RATE,
-        output=True,
-        stream_callback=_pyaudio_callback(wavgen) if not blocking else None
-    )
+    player = playback.Player(channels, device,
+                             playback.LATENCY if latency is None else latency,
+                             raw_samples=raw_samples, blocks=blocks, frames=frames)
+    player.start()
     if blocking:
-        try:
-            for chunk in buffer(wavgen, 1024):
-                stream.write(chunk)
-        except Exception:
-            raise
-        finally:
-            if not stream.is_stopped():
-                stream.stop_stream()
-            try:
-                stream.close()
-            except Exception:
-                pass
-    else:
-        return stream
+        player.wait()
+    return player
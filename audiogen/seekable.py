@@ -0,0 +1,186 @@
+'''
+Seekable sources
+
+Many sources are pure functions of the sample index: DDS tones, constants
+and silence, and keyed noise. Seekable sources expose that through
+`render(start, count)`, which returns the block (`array('d')`) of `count`
+samples beginning at sample `start`, in any order.
+
+Seekable sources also iterate like the ordinary per-sample generators
+they replace, starting from sample zero, and `blocks()` yields a block
+generator from any position, so they drop into existing pipelines.
+Combining seekable sources with `util.envelope()`, `util.volume()` or
+`util.mixer()` (with constant mix levels) keeps the result seekable.
+
+Because any part of a seekable source can be rendered independently,
+long renders can be split into time segments and rendered on several
+processes, see `audiogen.parallel` and `sampler.write_wav(workers=...)`.
+Seekable sources must be picklable for that.
+'''
+
+import array
+import operator
+
+import audiogen.noise as noise
+import audiogen.blocks as blocks
+import audiogen.sampler as sampler
+import audiogen.generators as generators
+
+
+class Seekable(object):
+    '''
+    Base class for seekable sources
+
+    Subclasses implement `render(start, count)` and set `length` to their
+    length in samples, or None if infinite. `render()` returns fewer than
+    `count` samples only past the end of finite sources.
+    '''
+    length = None
+
+    def render(self, start, count):
+        raise NotImplementedError
+
+    def _count(self, start, count):
+        # number of samples available from start, up to count
+        if self.length is None:
+            return count
+        return max(0, min(count, self.length - start))
+
+    def blocks(self, start=0, block_size=None):
+        '''Yield the source as blocks of `block_size` samples, from sample `start`'''
+        size = blocks._block_size(block_size)
+        while True:
+            count = self._count(start, size)
+            if count == 0:
+                return
+            yield self.render(start, count)
+            start += count
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if getattr(self, "_samples", None) is None:
+            self._samples = blocks.to_samples(self.blocks())
+        return next(self._samples)
+
+    def __getstate__(self):
+        # iteration state doesn't travel to worker processes
+        state = self.__dict__.copy()
+        state.pop("_samples", None)
+        return state
+
+
+def _length(seconds):
+    return None if seconds is None else int(sampler.FRAME_RATE * seconds)
+
+
+def _shortest(sources):
+    lengths = [source.length for source in sources if source.length is not None]
+    return min(lengths) if lengths else None
+
+
+class Constant(Seekable):
+    '''`value` for `seconds` seconds, infinite if `seconds` is None'''
+    def __init__(self, value, seconds=None):
+        self.value = value
+        self.length = _length(seconds)
+
+    def render(self, start, count):
+        return array.array('d', [self.value]) * self._count(start, count)
+
+    def __repr__(self):
+        return f"Constant({self.value})"
+
+
+def silence(seconds=None):
+    '''Seekable version of `generators.silence()`'''
+    return Constant(0, seconds)
+
+
+class Tone(Seekable):
+    '''
+    Seekable version of `DDS.dds()`
+
+    Renders with the settings and LUT of `dds`, the `DDS` class by default
+    or an instance of it.
+    '''
+    def __init__(self, frequency=440, phase_offset=0, dds=generators.DDS):
+        self.frequency = frequency
+        self.phase_offset = phase_offset
+        self.dds = dds
+
+    def render(self, start, count):
+        return self.dds.dds_segment(self.frequency, start, count, self.phase_offset)
+
+
+class Noise(Seekable):
+    '''
+    Seekable keyed noise, see `noise.white_noise_segment()`
+
+    `color` is one of `noise.NOISE_COLORS`; colors other than white
+    require NumPy.
+    '''
+    def __init__(self, key=(1, 2, 3, 4, 5), color='white'):
+        self.key = key
+        self.color = color
+
+    def render(self, start, count):
+        if self.color == 'white':
+            return noise.white_noise_segment(self.key, start, count)
+        return noise.colored_noise_segment(self.color, self.key, start, count)
+
+
+class Crop(Seekable):
+    '''The first `seconds` seconds of `source`'''
+    def __init__(self, source, seconds):
+        self.source = source
+        self.length = _length(seconds)
+        if source.length is not None:
+            self.length = min(self.length, source.length)
+
+    def render(self, start, count):
+        return self.source.render(start, self._count(start, count))
+
+
+class Envelope(Seekable):
+    '''`source` scaled by `volume`, a number or a seekable source'''
+    def __init__(self, source, volume):
+        self.source = source
+        self.volume = volume
+        self.length = _shortest([source, volume] if isinstance(volume, Seekable) else [source])
+
+    def render(self, start, count):
+        count = self._count(start, count)
+        samples = self.source.render(start, count)
+        volume = self.volume
+        if isinstance(volume, Seekable):
+            volume = volume.render(start, count)
+            if blocks.numpy_loaded:
+                return blocks.from_ndarray(blocks.as_ndarray(samples) * blocks.as_ndarray(volume))
+            return array.array('d', map(operator.mul, samples, volume))
+        if blocks.numpy_loaded:
+            return blocks.from_ndarray(blocks.as_ndarray(samples) * volume)
+        return array.array('d', [volume * sample for sample in samples])
+
+
+class Mix(Seekable):
+    '''Sum of `sources`, each scaled by the matching constant in `levels`'''
+    def __init__(self, sources, levels):
+        self.sources = list(sources)
+        self.levels = list(levels)
+        self.length = _shortest(self.sources)
+
+    def render(self, start, count):
+        count = self._count(start, count)
+        mixed = blocks.zeros(count)
+        for source, level in zip(self.sources, self.levels):
+            if not level:
+                continue
+            samples = source.render(start, count)
+            if blocks.numpy_loaded:
+                mixed = blocks.from_ndarray(blocks.as_ndarray(mixed)
+                                            + level * blocks.as_ndarray(samples))
+            else:
+                mixed = array.array('d', [m + level * s for m, s in zip(mixed, samples)])
+        return mixed
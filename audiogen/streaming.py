@@ -0,0 +1,110 @@
+'''
+asyncio streaming
+
+Async iterators over rendered audio, for serving many concurrent streams
+from one event loop, e.g. over HTTP or WebSockets:
+
+    async for chunk in audiogen.streaming.aiter_wav(audiogen.tone(440)):
+        await response.write(chunk)
+
+Rendering runs in an executor (the event loop's default thread pool
+unless another is given), one chunk at a time per stream, so the event
+loop itself never renders audio. A stream renders at most one chunk
+ahead of its consumer, so a slow client holds back only its own stream.
+Streams render with the `audiogen.config` current in the task that
+iterates them.
+'''
+
+import asyncio
+import functools
+import contextvars
+
+import audiogen.sampler as sampler
+from .wavfile import WavWriter
+
+# default frames per chunk, about 0.1 seconds at 44.1 kHz
+CHUNK_FRAMES = 4096
+
+
+class _ChunkSink(object):
+    # File-like object collecting what a WavWriter writes
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def _render(channels, options, executor):
+    # Yields (channel count, None) and then the rendered chunks as bytes
+    loop = asyncio.get_running_loop()
+    # render in this task's context, for its audiogen.config
+    context = contextvars.copy_context()
+    channel_count, stream = await loop.run_in_executor(
+        executor, context.run, functools.partial(sampler.wav_stream, channels, **options))
+    yield channel_count, None
+    pending = loop.run_in_executor(executor, context.run, next, stream, None)
+    while True:
+        chunk = await pending
+        if chunk is None:
+            return
+        chunk = bytes(chunk)
+        # render the next chunk while this one is consumed
+        pending = loop.run_in_executor(executor, context.run, next, stream, None)
+        yield channel_count, chunk
+
+
+def _options(sample_width, raw_samples, blocks, frames, chunk_frames):
+    return dict(sample_width=sampler.SAMPLE_WIDTH if sample_width is None else sample_width,
+                raw_samples=raw_samples, blocks=blocks, frames=frames,
+                chunk_size=CHUNK_FRAMES if chunk_frames is None else chunk_frames)
+
+
+async def aiter_pcm(channels, sample_width=None, raw_samples=False, blocks=False, frames=False,
+                    chunk_frames=None, executor=None):
+    '''
+    Async iterator of interleaved little endian PCM chunks of `channels`
+
+    `channels` and the `raw_samples`, `blocks` and `frames` options are as
+    for `sampler.write_wav()`. Per-sample generators are rendered
+    `chunk_frames` frames (default `CHUNK_FRAMES`) at a time; block and
+    `Frames` generators a block at a time. Renders in `executor`.
+    '''
+    options = _options(sample_width, raw_samples, blocks, frames, chunk_frames)
+    async for channel_count, chunk in _render(channels, options, executor):
+        if chunk is not None:
+            yield chunk
+
+
+async def aiter_wav(channels, sample_width=None, raw_samples=False, blocks=False, frames=False,
+                    chunk_frames=None, executor=None):
+    '''
+    Async iterator of a streamed WAVE file of `channels`
+
+    Yields the header, which claims the maximum data size as when writing
+    to a pipe (see `audiogen.wavfile`), and then the PCM chunks of
+    `aiter_pcm()`.
+    '''
+    options = _options(sample_width, raw_samples, blocks, frames, chunk_frames)
+    sink = _ChunkSink()
+    writer = None
+    async for channel_count, chunk in _render(channels, options, executor):
+        if writer is None:
+            writer = WavWriter(sink, channel_count, options['sample_width'], sampler.FRAME_RATE,
+                               seekable=False)
+            yield sink.take()
+        else:
+            writer.write(chunk)
+            yield sink.take()
+    writer.close()
+    padding = sink.take()
+    if padding:
+        yield padding
@@ -3,9 +3,20 @@ import logging
 
 from functools import reduce
 
+import array
 import itertools
 import math
+import operator
+import collections
 
+try:
+    import numpy
+    numpy_loaded = True
+except ImportError:
+    numpy_loaded = False
+
+import audiogen.blocks as blocks
+import audiogen.instrument as instrument
 import audiogen.sampler as sampler
 
 logger = logging.getLogger(__name__)
@@ -85,13 +96,18 @@ def crop_with_fade_out(gen, seconds, fade=.01):
         yield sample
 
 
-def crop_at_zero_crossing(gen, seconds=5, error=0.1):
+def crop_at_zero_crossing(gen, seconds=5, error=0.1, direction=None):
     '''
     Crop the generator, ending at a zero-crossing
 
     Crop the generator to produce approximately seconds seconds
     (default 5s) of audio at the provided FRAME_RATE, attempting
     to end the clip at a zero crossing point to avoid clicking.
+
+    The clip ends within `error` seconds of `seconds`, on the sample
+    nearest zero at the zero crossing closest to `seconds`, or on the
+    sample nearest zero if there's no crossing. `direction` may be
+    "rising" or "falling" to only consider crossings of that slope.
     '''
     source = iter(gen)
     buffer_length = int(2 * error * sampler.FRAME_RATE)
@@ -107,39 +123,304 @@ def crop_at_zero_crossing(gen, seconds=5, error=0.1):
     for sample in start:
         yield sample
 
-    # pull end buffer generator into memory so we can work with it
-    end = list(end)
+    # pull end buffer into memory so we can search it
+    end = array.array('d', end)
+    yield from end[:_zero_crossing_cut(end, direction)]
 
-    # find min by sorting buffer samples, first by abs of sample, then by distance from optimal
-    best = sorted(enumerate(end), key=lambda x: (math.fabs(x[1]), abs((buffer_length/2) - x[0])))
-    print(best[:10])
-    print(best[0][0])
 
-    # todo: better logic when we don't have a perfect zero crossing
-    # if best[0][1] != 0:
-    #     # we don't have a perfect zero crossing, so let's look for best fit?
-    #     pass
+def crop_blocks_at_zero_crossing(gen, seconds=5, error=0.1, direction=None):
+    '''Block generator version of `crop_at_zero_crossing()`'''
+    before = int((seconds - error) * sampler.FRAME_RATE)
+    buffer_length = int(2 * error * sampler.FRAME_RATE)
+    end = array.array('d')
+    for block in gen:
+        if before > 0:
+            head = block[:before]
+            before -= len(head)
+            yield head
+            block = block[len(head):]
+        end.extend(block[:buffer_length - len(end)])
+        if before <= 0 and len(end) == buffer_length:
+            break
+    end = end[:_zero_crossing_cut(end, direction)]
+    if len(end):
+        yield end
+
+
+# Zero crossings and loop points
+
+def zero_crossings(block, direction=None):
+    '''
+    Return the positions of the zero crossings in a block
 
-    # crop samples at index of best zero crossing
-    for sample in end[:best[0][0] + 1]:
-        yield sample
+    A crossing at position `i` lies between samples `i - 1` and `i`;
+    zero counts as positive. `direction` may be "rising" or "falling" to
+    only return crossings of that slope. With NumPy, returns an array.
+    '''
+    if direction not in (None, "rising", "falling"):
+        raise ValueError("Unknown zero crossing direction {0!r}".format(direction))
+    if numpy_loaded:
+        negative = blocks.as_ndarray(block) < 0
+        rising, falling = negative[:-1] & ~negative[1:], ~negative[:-1] & negative[1:]
+        crossed = rising if direction == "rising" else falling if direction == "falling" \
+            else rising | falling
+        return numpy.flatnonzero(crossed) + 1
+    return [i for i in range(1, len(block))
+            if (block[i - 1] < 0 <= block[i] and direction != "falling")
+            or (block[i] < 0 <= block[i - 1] and direction != "rising")]
+
+
+def _zero_crossing_cut(window, direction=None):
+    # Number of samples of window to keep to end at the zero crossing
+    # nearest its middle: keep up to the sample nearest zero of the two
+    # on either side of the crossing. Without crossings, end on the
+    # sample nearest zero, and nearest the middle among those.
+    if len(window) == 0:
+        return 0
+    middle = len(window) / 2.
+    crossings = zero_crossings(window, direction)
+    if len(crossings):
+        if numpy_loaded:
+            i = int(crossings[numpy.argmin(numpy.abs(crossings - middle))])
+        else:
+            i = min(crossings, key=lambda i: abs(i - middle))
+        last = i if abs(window[i]) < abs(window[i - 1]) else i - 1
+        logger.debug("Cropping at zero crossing %d of %d" % (last, len(window)))
+        return last + 1
+    if numpy_loaded:
+        samples = blocks.as_ndarray(window)
+        last = int(numpy.lexsort((numpy.abs(numpy.arange(len(samples)) - middle),
+                                  numpy.abs(samples)))[0])
+    else:
+        last = min(range(len(window)), key=lambda i: (abs(window[i]), abs(i - middle)))
+    logger.debug("No zero crossing, cropping at sample %d of %d" % (last, len(window)))
+    return last + 1
+
+
+def find_loop_point(samples, search=0.1, match=0.005):
+    '''
+    Find where to end a clip so that it loops seamlessly
+
+    Searches the last `search` seconds of `samples`, a finite sequence,
+    for the loop end `e` for which the `match` seconds following `e` best
+    match the start of the clip, so that `samples[:e]` repeats without a
+    jump. Returns `e` and its normalized cross correlation score, from -1
+    to 1 (a perfect match).
+
+    With NumPy, correlates every candidate at once through FFTs.
+    '''
+    count = len(samples)
+    length = max(1, min(int(match * sampler.FRAME_RATE), count // 2))
+    low = max(length, count - int(search * sampler.FRAME_RATE) - length)
+    candidates = count - length + 1 - low
+    if candidates <= 0:
+        return count, 0.0
+    if numpy_loaded:
+        data = blocks.as_ndarray(samples) if not isinstance(samples, numpy.ndarray) \
+            else samples
+        template, region = data[:length], data[low:]
+        size = 1 << (len(region) + length - 1).bit_length()
+        correlation = numpy.fft.irfft(numpy.fft.rfft(region, size) *
+                                      numpy.conj(numpy.fft.rfft(template, size)),
+                                      size)[:candidates]
+        energy = numpy.concatenate(((0.0,), numpy.cumsum(region ** 2)))
+        norms = numpy.sqrt((energy[length:length + candidates] - energy[:candidates])
+                           * numpy.dot(template, template))
+        scores = numpy.divide(correlation, norms, out=numpy.zeros(candidates),
+                              where=norms > 1e-12)
+        best = int(numpy.argmax(scores))
+        return low + best, float(scores[best])
+    template = list(samples[:length])
+    template_energy = sum(t * t for t in template)
+    best, best_score = count, -2.0
+    for e in range(low, low + candidates):
+        window = samples[e:e + length]
+        norm = math.sqrt(sum(s * s for s in window) * template_energy)
+        score = sum(t * s for t, s in zip(template, window)) / norm if norm > 1e-12 else 0.0
+        if score > best_score:
+            best, best_score = e, score
+    return best, best_score
+
+
+def loop_discontinuity(samples):
+    '''
+    Return the jump where finite `samples` wrap around, relative to its largest step
+
+    A clip loops seamlessly when the step from its last sample back to
+    its first is no larger than the steps within it, i.e. the result is
+    at most 1.
+    '''
+    if len(samples) < 2:
+        return 0.0
+    if numpy_loaded:
+        steps = numpy.abs(numpy.diff(blocks.as_ndarray(samples)))
+        largest = float(steps.max())
+    else:
+        largest = max(abs(b - a) for a, b in zip(samples, samples[1:]))
+    jump = abs(samples[0] - samples[-1])
+    if largest == 0:
+        return 0.0 if jump == 0 else float("inf")
+    return jump / largest
 
 
+@instrument.instrumented("normalize")
 def normalize(generator, min_in=0, max_in=256, min_out=-1, max_out=1):
     scale = float(max_out - min_out) / (max_in - min_in)
     return ((sample - min_in) * scale + min_out for sample in generator)
 
 
-def hard_clip(generator, min=-1, max=1):
-    for sample in generator:
-        if sample > max:
-            logger.warn("Warning, clipped value %f > max %f" % (sample, max))
-            yield max
-        elif sample < min:
-            logger.warn("Warning, clipped value %f < min %f" % (sample, min))
-            yield min
+class ClipStats(object):
+    '''
+    Aggregated statistics of the samples outside [`min`, `max`] in a stream
+
+    Call `update()` with each block in turn. `count` is the number of
+    samples clipped, `peak` the largest overshoot past either limit, and
+    `first` and `last` the positions of the first and last clipped
+    samples, in frames, or None. `report()` logs them in one message.
+    '''
+    def __init__(self, min=-1, max=1):
+        self.min = min
+        self.max = max
+        self.count = 0
+        self.peak = 0.0
+        self.first = None
+        self.last = None
+        # frames seen
+        self.position = 0
+
+    def update(self, samples):
+        '''
+        Record the clipped samples of a block
+
+        `samples` is a block or, with NumPy, a (frames, channels) array.
+        '''
+        if numpy_loaded:
+            self._update_ndarray(samples if isinstance(samples, numpy.ndarray)
+                                 else blocks.as_ndarray(samples))
         else:
-            yield sample
+            self._update_lists(samples)
+
+    def _update_ndarray(self, data):
+        frames = len(data)
+        if frames == 0 or (data.max() <= self.max and data.min() >= self.min):
+            self.position += frames
+            return
+        overshoot = numpy.maximum(data - self.max, self.min - data)
+        count = numpy.count_nonzero(overshoot > 0)
+        if data.ndim > 1:
+            overshoot = overshoot.max(axis=1)
+        clipped = numpy.flatnonzero(overshoot > 0)
+        self._record(count, float(overshoot.max()), int(clipped[0]), int(clipped[-1]))
+        self.position += frames
+
+    def _update_lists(self, samples):
+        high, low = self.max, self.min
+        clipped = [(i, s - high if s > high else low - s)
+                   for i, s in enumerate(samples) if s > high or s < low]
+        if clipped:
+            self._record(len(clipped), max(o for i, o in clipped), clipped[0][0], clipped[-1][0])
+        self.position += len(samples)
+
+    def _record(self, count, peak, first, last):
+        self.count += count
+        self.peak = max(self.peak, peak)
+        if self.first is None:
+            self.first = self.position + first
+        self.last = self.position + last
+        instrument.count("clipped samples", count)
+
+    def report(self):
+        '''Log a warning summing up the clipped samples, if any'''
+        if self.count:
+            logger.warning("Warning, clipped %d samples outside [%f, %f] by up to %f, "
+                           "from frame %d to %d" % (self.count, self.min, self.max, self.peak,
+                                                    self.first, self.last))
+
+    def __repr__(self):
+        return "ClipStats({0} clipped, peak overshoot {1:f})".format(self.count, self.peak)
+
+
+def _hard_clip_block(block, min, max):
+    if numpy_loaded:
+        return blocks.from_ndarray(numpy.clip(blocks.as_ndarray(block), min, max))
+    return array.array('d', [max if s > max else min if s < min else s for s in block])
+
+
+def _soft_clip_block(block, min, max):
+    # tanh saturation, scaled to the [min, max] range
+    center, half = (max + min) / 2., (max - min) / 2.
+    if numpy_loaded:
+        return blocks.from_ndarray(numpy.tanh((blocks.as_ndarray(block) - center) / half)
+                                   * half + center)
+    return array.array('d', [math.tanh((s - center) / half) * half + center for s in block])
+
+
+# clip_blocks() policies applied one block at a time
+CLIP_POLICIES = {
+    "hard": _hard_clip_block,
+    "soft": _soft_clip_block,
+}
+
+
+@instrument.instrumented("clip_blocks")
+def clip_blocks(gen, min=-1, max=1, policy="hard", stats=None, **kwargs):
+    '''
+    Keep a block generator within [`min`, `max`]
+
+    `policy` is one of:
+
+    - "hard": clip samples to the limits
+    - "soft": saturate with a scaled tanh curve; in range samples are
+      shaped too
+    - "limit": a lookahead peak limiter, see `audiogen.dynamics`; takes
+      the `lookahead` and `release` times in seconds as keyword arguments
+
+    Clipped samples are counted in `stats`, a `ClipStats`, by their
+    value before the policy applies. If `stats` isn't given, the count is
+    logged once, at the end of the stream.
+    '''
+    report = stats is None
+    if report:
+        stats = ClipStats(min, max)
+    if policy == "limit":
+        from .dynamics import limit_blocks
+
+        def counted(gen):
+            for block in gen:
+                stats.update(block)
+                yield block
+        clipped = limit_blocks(counted(gen), (max - min) / 2., center=(max + min) / 2., **kwargs)
+    else:
+        if policy not in CLIP_POLICIES:
+            raise ValueError("Unknown clip policy {0!r}".format(policy))
+        clip_block = CLIP_POLICIES[policy]
+
+        def clipped_blocks(gen):
+            for block in gen:
+                stats.update(block)
+                yield clip_block(block, min, max)
+        clipped = clipped_blocks(gen)
+    return _reported(clipped, stats) if report else clipped
+
+
+def _reported(gen, stats):
+    # yield from gen, then log stats
+    try:
+        yield from gen
+    finally:
+        stats.report()
+
+
+@instrument.instrumented("hard_clip")
+def hard_clip(generator, min=-1, max=1, policy="hard"):
+    '''
+    Clip a sample generator to [`min`, `max`]
+
+    Processes blocks of `sampler.BLOCK_SIZE` samples at a time with
+    `clip_blocks()`, which `policy` is passed to, and logs the clipped
+    samples once, at the end of the stream.
+    '''
+    return blocks.to_samples(clip_blocks(blocks.from_samples(generator), min, max, policy))
 
 
 def vector_reduce(op, generators):
@@ -151,6 +432,24 @@ def vector_reduce(op, generators):
         yield reduce(op, samples)
 
 
+def vector_reduce_blocks(op, generators):
+    '''
+    Block generator version of `vector_reduce()`
+
+    All of the block generators should share a block size. Output ends with
+    the shortest input.
+    '''
+    while True:
+        try:
+            blocks = [next(g) for g in generators]
+        except StopIteration:
+            return
+        count = min(len(b) for b in blocks)
+        yield array.array('d', reduce(lambda a, b: map(op, a, b), blocks))
+        if any(len(b) > count for b in blocks):
+            return
+
+
 def sum_generators(*generators):
     return vector_reduce(lambda a, b: a + b, generators)
 
@@ -159,6 +458,14 @@ def multiply(*generators):
     return vector_reduce(lambda a, b: a * b, generators)
 
 
+def sum_blocks(*generators):
+    return vector_reduce_blocks(operator.add, generators)
+
+
+def multiply_blocks(*generators):
+    return vector_reduce_blocks(operator.mul, generators)
+
+
 class Constant(object):
     def __init__(self, value):
         self.value = value
@@ -183,6 +490,16 @@ def constantf(value):
 # Filters
 
 
+def _seekable_level(level):
+    # level as a number or seekable source, or None if it is neither
+    from .seekable import Seekable
+    if isinstance(level, Constant):
+        return level.value
+    if isinstance(level, (int, float, Seekable)):
+        return level
+    return None
+
+
 def volume(gen, dB=0):
     '''Change the volume of gen by dB decibles'''
     if not hasattr(dB, "__next__"):
@@ -212,6 +529,19 @@ def clip(gen, limit):
 
 
 def envelope(gen, volume):
+    '''
+    Scale `gen` by `volume`, a number or a generator of levels
+
+    Returns a seekable source if `gen` is seekable and `volume` is
+    constant or seekable, see `audiogen.seekable`.
+    '''
+    if hasattr(gen, "render") and _seekable_level(volume) is not None:
+        from .seekable import Envelope
+        return Envelope(gen, _seekable_level(volume))
+    return _envelope(gen, volume)
+
+
+def _envelope(gen, volume):
     if not hasattr(volume, "__next__"):
         volume = constant(volume)
     while True:
@@ -223,8 +553,39 @@ def envelope(gen, volume):
         yield current_volume * sample
 
 
-def loop(*gens):
+def envelope_blocks(gen, volume):
+    '''
+    Block generator version of `envelope()`
+
+    `volume` may be a number or a block generator of volume levels.
+    '''
+    if not hasattr(volume, "__next__"):
+        for b in gen:
+            yield array.array('d', [volume * sample for sample in b])
+        return
+    yield from multiply_blocks(gen, volume)
+
+
+def volume_blocks(gen, dB=0):
+    '''Block generator version of `volume()`, taking a fixed `dB` change'''
+    return envelope_blocks(gen, 10 ** (dB / 20.))
+
+
+def loop(*gens, seamless=False):
+    '''
+    Repeat the samples of finite generators `gens` in turn, forever
+
+    If `seamless` is True, each clip that doesn't wrap around seamlessly
+    (see `loop_discontinuity()`) is cut at its best loop point, see
+    `find_loop_point()`.
+    '''
     loops = [list(gen) for gen in gens]
+    if seamless:
+        for i, samples in enumerate(loops):
+            if loop_discontinuity(samples) > 1:
+                end, score = find_loop_point(samples)
+                logger.debug("Looping %d of %d samples, match %f" % (end, len(samples), score))
+                loops[i] = samples[:end]
     while True:
         for loop in loops:
             for sample in loop:
@@ -260,6 +621,9 @@ def mixer(inputs, mix=None):
     will be mixed together into one generator, with the volume of
     each reduced *n*-fold.
 
+    If all of the inputs are seekable and all of the mix levels are
+    constant, the outputs are seekable sources, see `audiogen.seekable`.
+
     Example:
 
         # three in, two out;
@@ -282,33 +646,147 @@ def mixer(inputs, mix=None):
         mix = ([constant(1.0 / len(inputs))] * len(inputs),)
         # mix = (itertools.tee(constant(1.0 / len(inputs)), len(inputs)),)
 
-    outputChannelCount = len(mix)
+    levels = [[_seekable_level(level) for level in mixes] for mixes in mix]
+    if all(hasattr(i, "render") for i in inputs) \
+            and all(isinstance(level, (int, float)) for mixes in levels for level in mixes):
+        from .seekable import Mix
+        return [Mix(inputs, mixes) for mixes in levels]
+
+    # run the block mixing engine, pulling a block of each input at a time
+    def level_blocks(level):
+        if isinstance(level, Constant):
+            return level.value
+        if hasattr(level, "__next__"):
+            return blocks.from_samples(level)
+        return level
+    blockLevels = {}
+    for mixes in mix:
+        for level in mixes:
+            if id(level) not in blockLevels:
+                # level generators used more than once are pulled once per block
+                blockLevels[id(level)] = level_blocks(level)
+    outputs = mixer_blocks([blocks.from_samples(i) for i in inputs],
+                           [[blockLevels[id(level)] for level in mixes] for mixes in mix])
+    return [blocks.to_samples(output) for output in outputs]
+
+
+class _MixEngine(object):
+    # Pulls one block from every input and mix level per step, computing
+    # every output's block at once and queueing it for that output
+    def __init__(self, inputs, mix):
+        self.inputs = list(inputs)
+        self.mix = [list(levels) for levels in mix]
+        self.pending = [collections.deque() for levels in self.mix]
+        self.done = False
+
+    def step(self):
+        try:
+            inputBlocks = [next(i) for i in self.inputs]
+        except StopIteration:
+            self.done = True
+            return
+        outputs = self.mix_blocks(inputBlocks)
+        for queue, output in zip(self.pending, outputs):
+            queue.append(output)
 
-    # Create a copy of the inputs for each of the output channels
-    # list of tuples, len inputChannelCount. Each tuple has outputChannelCount copies of the input.
-    inputCopies = [itertools.tee(i, outputChannelCount) for i in inputs]
+    def mix_blocks(self, inputBlocks):
+        # Mix one block of each input into a list of output blocks, empty
+        # once a level generator ends
+        try:
+            pulled = {}
+            for levels in self.mix:
+                for level in levels:
+                    if hasattr(level, "__next__") and id(level) not in pulled:
+                        pulled[id(level)] = next(level)
+        except StopIteration:
+            self.done = True
+            return []
+        gains = [[pulled.get(id(level), level) for level in levels] for levels in self.mix]
+        lengths = [len(b) for b in inputBlocks] + [len(b) for b in pulled.values()]
+        count = min(lengths)
+        if max(lengths) > count:
+            # an input or level ended mid-block
+            self.done = True
+        if numpy_loaded:
+            return self._mix_ndarray(inputBlocks, gains, count)
+        return self._mix_lists(inputBlocks, gains, count)
+
+    def _mix_ndarray(self, inputBlocks, gains, count):
+        samples = numpy.empty((len(inputBlocks), count))
+        for i, b in enumerate(inputBlocks):
+            samples[i] = blocks.as_ndarray(b)[:count]
+        if all(isinstance(g, (int, float)) for levels in gains for g in levels):
+            # the usual case: a fixed routing matrix
+            return [blocks.from_ndarray(row) for row in numpy.array(gains, dtype=float) @ samples]
+        matrix = numpy.empty((len(gains), len(inputBlocks), count))
+        for o, levels in enumerate(gains):
+            for i, g in enumerate(levels):
+                matrix[o, i] = g if isinstance(g, (int, float)) else blocks.as_ndarray(g)[:count]
+        return [blocks.from_ndarray(row) for row in numpy.einsum('oin,in->on', matrix, samples)]
+
+    def _mix_lists(self, inputBlocks, gains, count):
+        outputs = []
+        for levels in gains:
+            mixed = [0.0] * count
+            for g, b in zip(levels, inputBlocks):
+                if isinstance(g, (int, float)):
+                    if g:
+                        mixed = [m + g * s for m, s in zip(mixed, b)]
+                else:
+                    mixed = [m + level * s for m, level, s in zip(mixed, g, b)]
+            outputs.append(array.array('d', mixed))
+        return outputs
+
+    def output(self, channel):
+        queue = self.pending[channel]
+        while True:
+            if queue:
+                yield queue.popleft()
+            elif self.done:
+                return
+            else:
+                self.step()
 
-    # For every output channel, a (copied) tuple of all inputs
-    outputSources = zip(*inputCopies)
 
-    # a pair of (inputCount mixes, inputCount sources) per output channel
-    outputData = zip(mix, outputSources)
+def mixer_blocks(inputs, mix=None):
+    '''
+    Block generator version of `mixer()`
 
-    outputChannels = []
-    # for each output channel
-    for mixes, inputs in outputData:
-        # inputCount pairs of (mixGenerator, inputGenerator)
-        outputChannelData = zip(mixes, inputs)
+    `inputs` are *n* block generators, sharing a block size. `mix` holds
+    one tuple of *n* levels per output channel; levels are numbers or
+    block generators of levels. Returns a list of *m* block generators.
 
-        # list of inputCount volume-corrected audio generators
-        normalizedInputs = [multiply(mixGen, inputGen) for mixGen, inputGen in outputChannelData]
+    Each step pulls one block from every input and level and computes the
+    blocks of all outputs together, with NumPy as one matrix product of
+    the mix levels and the input blocks. Blocks wait in a queue for outputs
+    that are read less often than others.
+    '''
+    if mix is None:
+        mix = ([1.0 / len(inputs)] * len(inputs),)
+    engine = _MixEngine(inputs, mix)
+    return [engine.output(channel) for channel in range(len(engine.mix))]
 
-        # sum together each of the normalized inputs to form the output for this channel
-        summedInputs = sum_generators(*normalizedInputs)
 
-        outputChannels.append(summedInputs)
+def mixer_frames(frames, mix=None):
+    '''
+    `mixer_blocks()` for a generator of multichannel `blocks.Frames`
 
-    return outputChannels
+    Mixes the *n* channels of each `Frames` into *m* output channels as
+    set out by `mix`, yielding `Frames`. By default, mixes all channels
+    down to one at equal levels.
+    '''
+    engine = None
+    for frame in frames:
+        if engine is None:
+            if mix is None:
+                mix = ([1.0 / frame.channel_count] * frame.channel_count,)
+            engine = _MixEngine((), mix)
+        outputs = engine.mix_blocks(frame.channels)
+        if not outputs:
+            return
+        yield blocks.Frames(outputs)
+        if engine.done:
+            return
 
 
 def channelize(gen, channels):
@@ -321,12 +799,15 @@ def channelize(gen, channels):
     Since multi-channel generators are the only reasonable way to synchronize samples
     across channels, and the sampler functions only take tuples of generators,
     you must use this function to process synchronized streams for output.
+
+    Nothing is pulled from `gen` until a channel is read. The channels
+    returned here buffer blocks without bound when one is read ahead of
+    the others; for long renders, prefer passing multichannel
+    `blocks.Frames` straight to the sampler functions with `frames=True`,
+    see `blocks.from_tuples()`.
     '''
-    def pick(g, channel):
-        for samples in g:
-            yield samples[channel]
-    return [pick(gen_copy, channel)
-            for channel, gen_copy in enumerate(itertools.tee(gen, channels))]
+    outputs = blocks.split(blocks.from_tuples(samples[:channels] for samples in gen), channels)
+    return [blocks.to_samples(output) for output in outputs]
 
 
 def play(filename):
@@ -0,0 +1,130 @@
+'''
+Streaming WAVE file writer
+
+Writes RIFF WAVE files without the standard library's `wave` module, so
+that output is not limited to 4 GiB and doesn't depend on `wave`
+internals.
+
+On seekable files, a JUNK chunk reserves room for an RF64 "ds64" chunk
+and the header sizes are back-patched when the writer is closed. Files
+whose data outgrow the 32 bit RIFF size fields are converted to RF64
+(EBU Tech 3306) in place.
+
+On non-seekable files, e.g. STDOUT to a pipe, the header is written once
+with the maximum RIFF and data sizes, which streaming readers take to
+mean "read until end of file".
+'''
+
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# KSDATAFORMAT_SUBTYPE_PCM, 00000001-0000-0010-8000-00aa00389b71
+SUBTYPE_PCM = bytes.fromhex('0100000000001000800000aa00389b71')
+
+MAX_CHUNK_SIZE = 0xFFFFFFFF
+
+# JUNK chunk payload size, replaced by ds64 in RF64 files:
+# RIFF size, data size, sample count (64 bits each) and an empty table
+DS64_SIZE = 28
+
+
+def fmt_chunk(channels, sample_width, frame_rate, extensible=None):
+    '''
+    Return the "fmt " chunk for PCM audio
+
+    Uses WAVE_FORMAT_EXTENSIBLE when `extensible` is True, or by default
+    for more than two channels or more than 16 bits per sample.
+    '''
+    if extensible is None:
+        extensible = channels > 2 or sample_width > 2
+    block_align = channels * sample_width
+    bits = sample_width * 8
+    if not extensible:
+        payload = struct.pack('<HHIIHH', WAVE_FORMAT_PCM, channels, frame_rate,
+                              frame_rate * block_align, block_align, bits)
+    else:
+        # speakers assigned in the standard order for the first channels
+        channel_mask = (1 << channels) - 1 if channels <= 18 else 0
+        payload = struct.pack('<HHIIHHHHI16s', WAVE_FORMAT_EXTENSIBLE, channels, frame_rate,
+                              frame_rate * block_align, block_align, bits,
+                              22, bits, channel_mask, SUBTYPE_PCM)
+    return b'fmt ' + struct.pack('<I', len(payload)) + payload
+
+
+class WavWriter(object):
+    '''
+    Streaming PCM WAVE writer
+
+    Write interleaved little endian frames (any bytes-like object) with
+    `write()`, then `close()` to finalize the header. Also usable as a
+    context manager. Does not close the underlying file.
+    '''
+    def __init__(self, f, channels, sample_width, frame_rate, seekable=True, extensible=None):
+        self.f = f
+        self.seekable = seekable
+        self.block_align = channels * sample_width
+        self.data_size = 0
+        self.closed = False
+
+        fmt = fmt_chunk(channels, sample_width, frame_rate, extensible)
+        if seekable:
+            self.start = f.tell()
+            junk = b'JUNK' + struct.pack('<I', DS64_SIZE) + bytes(DS64_SIZE)
+            self.header = b'RIFF' + struct.pack('<I', 0) + b'WAVE' + junk + fmt + b'data'
+            self.f.write(self.header + struct.pack('<I', 0))
+        else:
+            header = b'WAVE' + fmt + b'data'
+            data_size = (MAX_CHUNK_SIZE - len(header) - 4) // self.block_align * self.block_align
+            self.f.write(b'RIFF' + struct.pack('<I', MAX_CHUNK_SIZE) + header
+                         + struct.pack('<I', data_size))
+
+    def write(self, data):
+        '''Write bytes-like `data`, a whole number of frames'''
+        self.f.write(data)
+        self.data_size += memoryview(data).nbytes
+
+    @property
+    def frames(self):
+        '''Number of frames written so far'''
+        return self.data_size // self.block_align
+
+    def close(self):
+        '''Pad the data chunk and, on seekable files, back-patch the header'''
+        if self.closed:
+            return
+        self.closed = True
+        if self.data_size % 2:
+            # chunks are word aligned
+            self.f.write(b'\x00')
+        if not self.seekable:
+            self.f.flush()
+            return
+
+        end = self.f.tell()
+        riff_size = len(self.header) + 4 - 8 + self.data_size + self.data_size % 2
+        self.f.seek(self.start)
+        if riff_size <= MAX_CHUNK_SIZE:
+            self.f.write(b'RIFF' + struct.pack('<I', riff_size))
+            self.f.seek(self.start + len(self.header))
+            self.f.write(struct.pack('<I', self.data_size))
+        else:
+            logger.debug("Data size {0} exceeds RIFF limits, writing RF64".format(
+                self.data_size))
+            self.f.write(b'RF64' + struct.pack('<I', MAX_CHUNK_SIZE) + b'WAVE')
+            self.f.write(b'ds64' + struct.pack('<IQQQI', DS64_SIZE, riff_size,
+                                               self.data_size, self.frames, 0))
+            self.f.seek(self.start + len(self.header))
+            self.f.write(struct.pack('<I', MAX_CHUNK_SIZE))
+        self.f.seek(end)
+        self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+'''
+audiogen benchmarks
+
+Measures throughput, in samples per second, and peak memory of the
+generators, filters and sinks, for each combination of frame rate and
+channel count asked for. Each benchmark renders `--seconds` of audio per
+channel.
+
+    python -m benchmark.bench --json results.json
+    python -m benchmark.bench --compare results.json
+
+Run it from the repository root, as `make bench` does, to benchmark the
+checkout rather than an installed audiogen.
+
+`--compare` reports the change against earlier results and exits with
+status 1 if any benchmark's throughput fell by more than `--tolerance`.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import collections
+import tracemalloc
+
+import audiogen
+import audiogen.noise
+import audiogen.blocks as blocks
+import audiogen.filters as filters
+import audiogen.generators as generators
+import audiogen.util as util
+
+benchmarks = collections.OrderedDict()
+
+
+def benchmark(name, numpy=False, scipy=False):
+    '''
+    Register a benchmark
+
+    The decorated function takes the seconds of audio per channel and the
+    channel count, and renders that audio when called.
+    '''
+    def register(f):
+        if numpy and not blocks.numpy_loaded or scipy and not filters.scipy_loaded:
+            return f
+        benchmarks[name] = f
+        return f
+    return register
+
+
+def drain(iterable):
+    '''Consume and discard an iterable'''
+    collections.deque(iterable, maxlen=0)
+
+
+def drain_channels(make_channel, channels):
+    for channel in range(channels):
+        drain(make_channel())
+
+
+def drain_blocks(make_channel, channels, seconds):
+    for channel in range(channels):
+        drain(blocks.crop(make_channel(), seconds))
+
+
+# Generators
+
+@benchmark("dds")
+def bench_dds(seconds, channels):
+    drain_channels(lambda: util.crop(generators.dds(440), seconds), channels)
+
+
+@benchmark("dds_blocks")
+def bench_dds_blocks(seconds, channels):
+    drain_blocks(lambda: generators.dds_blocks(440), channels, seconds)
+
+
+@benchmark("tone")
+def bench_tone(seconds, channels):
+    drain_channels(lambda: util.crop(audiogen.tone(440, min_=-0.5, max_=0.5), seconds), channels)
+
+
+@benchmark("tone_wavetable")
+def bench_tone_wavetable(seconds, channels):
+    drain_channels(lambda: util.crop(audiogen.tone(440, use_wavetable=True), seconds), channels)
+
+
+@benchmark("tone_fm")
+def bench_tone_fm(seconds, channels):
+    drain_channels(lambda: util.crop(audiogen.tone(util.constant(440)), seconds), channels)
+
+
+@benchmark("beep")
+def bench_beep(seconds, channels):
+    drain_channels(lambda: audiogen.beep(440, seconds), channels)
+
+
+@benchmark("silence")
+def bench_silence(seconds, channels):
+    drain_channels(lambda: audiogen.silence(seconds), channels)
+
+
+# Noise
+
+@benchmark("white_noise")
+def bench_white_noise(seconds, channels):
+    drain_channels(lambda: util.crop(audiogen.noise.white_noise(), seconds), channels)
+
+
+@benchmark("red_noise")
+def bench_red_noise(seconds, channels):
+    drain_channels(lambda: util.crop(audiogen.noise.red_noise(), seconds), channels)
+
+
+@benchmark("white_noise_blocks")
+def bench_white_noise_blocks(seconds, channels):
+    drain_blocks(lambda: audiogen.noise.white_noise_blocks(), channels, seconds)
+
+
+@benchmark("red_noise_blocks")
+def bench_red_noise_blocks(seconds, channels):
+    drain_blocks(lambda: audiogen.noise.red_noise_blocks(), channels, seconds)
+
+
+def colored_noise_benchmark(color):
+    @benchmark("{0}_noise_blocks".format(color), numpy=True)
+    def bench(seconds, channels):
+        drain_blocks(lambda: audiogen.noise.colored_noise_blocks(color), channels, seconds)
+
+
+for color in ("pink", "brown", "blue", "violet"):
+    colored_noise_benchmark(color)
+
+
+# Filters
+
+def filter_benchmark(name, make_filter, **requirements):
+    @benchmark("filter_{0}".format(name), **requirements)
+    def bench(seconds, channels):
+        drain_channels(lambda: make_filter()(util.crop(audiogen.noise.white_noise(), seconds)),
+                       channels)
+
+    @benchmark("filter_{0}_blocks".format(name), **requirements)
+    def bench_blocks(seconds, channels):
+        drain_channels(lambda: make_filter().blocks(
+            blocks.crop(audiogen.noise.white_noise_blocks(), seconds)), channels)
+
+
+filter_benchmark("band_pass", lambda: filters.band_pass(440, 128))
+filter_benchmark("band_stop", lambda: filters.band_stop(440, 128))
+filter_benchmark("low_pass", lambda: filters.low_pass(1000))
+filter_benchmark("low_pass_four_stage", lambda: filters.low_pass_four_stage(1000))
+filter_benchmark("high_pass", lambda: filters.high_pass(1000))
+for family in ("butterworth", "chebyshev"):
+    for kind, frequency in (("low_pass", 1000), ("high_pass", 1000), ("band_pass", (300, 3000))):
+        filter_benchmark("{0}_{1}".format(family, kind),
+                         lambda family=family, kind=kind, frequency=frequency:
+                         getattr(filters, family)(kind, frequency))
+
+
+# Mixing and cropping
+
+@benchmark("mixer")
+def bench_mixer(seconds, channels):
+    # four inputs to `channels` outputs
+    inputs = [util.crop(generators.dds(440 * (i + 1)), seconds) for i in range(4)]
+    mix = [[util.constant(0.25)] * len(inputs) for channel in range(channels)]
+    outputs = util.mixer(inputs, mix)
+    drain(zip(*outputs))
+
+
+@benchmark("mixer_blocks")
+def bench_mixer_blocks(seconds, channels):
+    inputs = [blocks.crop(generators.dds_blocks(440 * (i + 1)), seconds) for i in range(4)]
+    outputs = util.mixer_blocks(inputs, [[0.25] * len(inputs) for channel in range(channels)])
+    drain(zip(*outputs))
+
+
+@benchmark("crop")
+def bench_crop(seconds, channels):
+    drain_channels(lambda: util.crop(util.constant(0.5), seconds), channels)
+
+
+@benchmark("crop_with_fades")
+def bench_crop_with_fades(seconds, channels):
+    drain_channels(lambda: util.crop_with_fades(generators.dds(440), seconds), channels)
+
+
+@benchmark("crop_with_fade_out")
+def bench_crop_with_fade_out(seconds, channels):
+    drain_channels(lambda: util.crop_with_fade_out(generators.dds(440), seconds), channels)
+
+
+@benchmark("crop_at_zero_crossing")
+def bench_crop_at_zero_crossing(seconds, channels):
+    # keep the crop window within short renders
+    error = min(0.1, seconds / 4)
+    drain_channels(lambda: util.crop_at_zero_crossing(generators.dds(440), seconds, error),
+                   channels)
+
+
+# Sinks
+
+def tones(seconds, channels):
+    return [util.crop(generators.dds(440 + 110 * channel), seconds) for channel in range(channels)]
+
+
+def tone_blocks(seconds, channels):
+    return [blocks.crop(generators.dds_blocks(440 + 110 * channel), seconds)
+            for channel in range(channels)]
+
+
+@benchmark("write_wav_file")
+def bench_write_wav_file(seconds, channels):
+    with tempfile.TemporaryFile() as f:
+        audiogen.sampler.write_wav(f, tones(seconds, channels))
+
+
+@benchmark("write_wav_file_blocks")
+def bench_write_wav_file_blocks(seconds, channels):
+    with tempfile.TemporaryFile() as f:
+        audiogen.sampler.write_wav(f, tone_blocks(seconds, channels), blocks=True)
+
+
+@benchmark("write_wav_pipe")
+def bench_write_wav_pipe(seconds, channels):
+    read_fd, write_fd = os.pipe()
+
+    def reader():
+        with os.fdopen(read_fd, "rb") as f:
+            while f.read(2**16):
+                pass
+    thread = threading.Thread(target=reader)
+    thread.start()
+    with os.fdopen(write_fd, "wb") as f:
+        audiogen.sampler.write_wav(f, tones(seconds, channels))
+    thread.join()
+
+
+# Harness
+
+def measure(f, seconds, channels, repeat):
+    '''Return the best time of `repeat` runs and the peak traced memory of one more'''
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        f(seconds, channels)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        f(seconds, channels)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run(names, frame_rates, channel_counts, seconds, repeat):
+    results = []
+    for frame_rate in frame_rates:
+        with audiogen.sampler.frame_rate(frame_rate):
+            for channels in channel_counts:
+                for name in names:
+                    elapsed, peak = measure(benchmarks[name], seconds, channels, repeat)
+                    samples = int(seconds * frame_rate) * channels
+                    result = dict(name=name, frame_rate=frame_rate, channels=channels,
+                                  seconds=elapsed, samples_per_second=samples / elapsed,
+                                  peak_bytes=peak)
+                    results.append(result)
+                    yield result
+
+
+def result_key(result):
+    return result["name"], result["frame_rate"], result["channels"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument(
+        "-k", "--select",
+        default=None,
+        help="Only run benchmarks whose names match this regular expression.",
+    )
+    parser.add_argument(
+        "-r", "--frame-rates",
+        default="44100",
+        help="Comma separated frame rates in Hertz.",
+    )
+    parser.add_argument(
+        "-c", "--channels",
+        default="1",
+        help="Comma separated channel counts.",
+    )
+    parser.add_argument(
+        "-s", "--seconds",
+        type=float,
+        default=1.0,
+        help="Seconds of audio per channel for each benchmark.",
+    )
+    parser.add_argument(
+        "-n", "--repeat",
+        type=int,
+        default=3,
+        help="Timed runs per benchmark; the fastest counts.",
+    )
+    parser.add_argument(
+        "--json",
+        default=None,
+        help="Write results to this JSON file.",
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="Compare with results from an earlier --json run.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Fraction of throughput a benchmark may lose before --compare fails.",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List benchmarks and exit.",
+    )
+    args = parser.parse_args()
+
+    names = [name for name in benchmarks
+             if args.select is None or re.search(args.select, name)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = {result_key(result): result for result in json.load(f)["results"]}
+
+    frame_rates = [int(rate) for rate in args.frame_rates.split(",")]
+    channel_counts = [int(count) for count in args.channels.split(",")]
+    results = []
+    regressions = 0
+    print("{0:<36} {1:>6} {2:>3} {3:>14} {4:>11} {5:>8}".format(
+        "benchmark", "rate", "ch", "samples/s", "peak KiB", "change"))
+    for result in run(names, frame_rates, channel_counts, args.seconds, args.repeat):
+        results.append(result)
+        change = ""
+        previous = baseline.get(result_key(result))
+        if previous is not None:
+            ratio = result["samples_per_second"] / previous["samples_per_second"]
+            change = "{0:+.1%}".format(ratio - 1)
+            if ratio < 1 - args.tolerance:
+                change += " !"
+                regressions += 1
+        print("{0:<36} {1:>6} {2:>3} {3:>14,.0f} {4:>11,.1f} {5:>8}".format(
+            result["name"], result["frame_rate"], result["channels"],
+            result["samples_per_second"], result["peak_bytes"] / 1024., change))
+        sys.stdout.flush()
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(dict(
+                audiogen=audiogen.__version__,
+                python=platform.python_version(),
+                machine=platform.machine(),
+                numpy=blocks.numpy_loaded,
+                scipy=filters.scipy_loaded,
+                seconds=args.seconds,
+                results=results,
+            ), f, indent=2)
+
+    if regressions:
+        print("{0} benchmark(s) slower than the baseline by more than {1:.0%}".format(
+            regressions, args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    # don't interleave clipping warnings with the results
+    logging.basicConfig(level=logging.ERROR)
+    sys.exit(main())
@@ -6,6 +6,8 @@ import os
 required_modules = []
 extras_require = {
     'soundcard_playback': ['pyaudio'],
+    'vectorized_blocks': ['numpy'],
+    'fast_filters': ['numpy', 'scipy'],
 }
 
 with open(os.path.join(os.path.dirname(__file__), "README.rst"), encoding='utf-8') as f:
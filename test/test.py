@@ -1,7 +1,18 @@
 # coding=utf8
 
+import array
+import io
+import math
+import os
+import wave
+import tempfile
+import itertools
+
+import pytest
+
 import audiogen
-from itertools import izip_longest
+import audiogen.noise
+from itertools import zip_longest
 
 unit = audiogen.util.constant(1)
 
@@ -21,6 +32,450 @@ def test_mux_duplicated_content():
 		print("Channel {}: {}".format(num, ", ".join([str(c) for c in channel])))
 
 	for channel in saved:
-		for sample, test in izip_longest(channel, range(10)):
+		for sample, test in zip_longest(channel, range(10)):
 			assert(sample == test)
 
+
+def test_block_adapters_round_trip():
+	blocks = list(audiogen.blocks.from_samples(range(2500), 1024))
+	assert [len(b) for b in blocks] == [1024, 1024, 452]
+	assert list(audiogen.blocks.to_samples(blocks)) == list(range(2500))
+
+def test_dds_blocks_match_dds():
+	samples = list(itertools.islice(audiogen.generators.dds(440), 3000))
+	blocks = audiogen.generators.dds_blocks(440, block_size=1000)
+	assert list(itertools.islice(audiogen.blocks.to_samples(blocks), 3000)) == samples
+
+def test_iir_blocks_match_iir():
+	samples = list(itertools.islice(audiogen.generators.dds(440), 3000))
+	bpf = audiogen.filters.band_pass(440, 128)
+	expected = list(bpf(iter(samples)))
+	output = list(audiogen.blocks.to_samples(bpf.blocks(audiogen.blocks.from_samples(samples))))
+	assert len(output) == len(expected)
+	for sample, test in zip(output, expected):
+		assert abs(sample - test) < 1e-9
+
+def test_high_order_iir_blocks_match_iir():
+	samples = list(itertools.islice(audiogen.generators.dds(440), 5000))
+	lpf = audiogen.filters.low_pass_four_stage(20)
+	expected = list(lpf(iter(samples)))
+	output = list(audiogen.blocks.to_samples(lpf.blocks(audiogen.blocks.from_samples(samples))))
+	assert len(output) == len(expected)
+	# both forms round differently, by about 1e-9 on this ill-conditioned filter
+	for sample, test in zip(output, expected):
+		assert abs(sample - test) < 1e-8
+
+def test_wav_blocks_match_wav_samples():
+	samples = list(itertools.islice(audiogen.generators.dds(440), 3000))
+	expected = b"".join(audiogen.sampler.wav_samples([iter(samples), iter(samples[::-1])]))
+	output = b"".join(audiogen.sampler.wav_blocks([
+		audiogen.blocks.from_samples(samples),
+		audiogen.blocks.from_samples(samples[::-1]),
+	]))
+	assert output == expected
+
+def test_dds_bank_matches_dds():
+	frequencies = (350, 440, 697)
+	bank = audiogen.generators.dds_bank(frequencies, block_size=1000)
+	channels = zip(*itertools.islice(bank, 3))
+	for frequency, channel in zip(frequencies, channels):
+		expected = list(itertools.islice(audiogen.generators.dds(frequency), 3000))
+		assert list(audiogen.blocks.to_samples(channel)) == expected
+
+def test_block_iir_carries_state_across_blocks():
+	samples = list(itertools.islice(audiogen.generators.dds(440), 3000))
+	whole = audiogen.filters.BlockIIR([0.5, 0.2], [0.3])(samples)
+	engine = audiogen.filters.BlockIIR([0.5, 0.2], [0.3])
+	split = list(engine(samples[:1000])) + list(engine(samples[1000:]))
+	for sample, test in zip(split, whole):
+		assert abs(sample - test) < 1e-12
+
+def test_iir_blocks_skip_empty_first_block():
+	bpf = audiogen.filters.band_pass(440, 128)
+	source = [array.array('d'), array.array('d', range(1000)), array.array('d', range(1000))]
+	assert [len(b) for b in bpf.blocks(iter(source))] == [1000, 1000, 2]
+
+def test_butterworth_sos_response():
+	with audiogen.sampler.frame_rate(48000):
+		lpf = audiogen.filters.butterworth("low_pass", 1000, order=6)
+		passband = list(itertools.islice(lpf(audiogen.generators.dds(100)), 48000))
+		stopband = list(itertools.islice(lpf(audiogen.generators.dds(8000)), 48000))
+	assert 0.95 < max(passband[24000:]) < 1.01
+	assert max(stopband[24000:]) < 0.001
+
+def test_sos_designs_are_cached_per_frame_rate():
+	design = audiogen.filters.design_sos("chebyshev", "high_pass", 500, 4, 0.5)
+	assert audiogen.filters.design_sos("chebyshev", "high_pass", 500, 4, 0.5) is design
+	with audiogen.sampler.frame_rate(8000):
+		assert audiogen.filters.design_sos("chebyshev", "high_pass", 500, 4, 0.5) != design
+
+def test_pack_blocks_match_wav_samples():
+	left = [(i % 300) / 100.0 - 1.5 for i in range(3000)]
+	right = list(itertools.islice(audiogen.generators.dds(440), 3000))
+	for width in (2, 4):
+		expected = b"".join(audiogen.sampler.wav_samples([iter(left), iter(right)], width))
+		output = b"".join(audiogen.sampler.pack_blocks([
+			audiogen.blocks.from_samples(left),
+			audiogen.blocks.from_samples(right),
+		], width=width))
+		assert output == expected
+
+def test_write_wav_seekable_header():
+	f = io.BytesIO()
+	audiogen.sampler.write_wav(f, [audiogen.beep(), audiogen.beep(880)])
+	f.seek(0)
+	w = wave.open(f)
+	assert w.getnchannels() == 2
+	assert w.getnframes() == len(list(audiogen.beep()))
+
+def test_write_wav_streaming_header():
+	f = io.BytesIO()
+	audiogen.sampler.write_wav(f, audiogen.beep(), seekable=False)
+	header = f.getvalue()[:44]
+	assert header[:4] == b"RIFF" and header[4:8] == b"\xff\xff\xff\xff"
+	assert header[36:40] == b"data"
+
+def test_sample_cache_spills_and_evicts():
+	directory = tempfile.mkdtemp()
+	cache = audiogen.cache.SampleCache(
+		max_bytes=10000, max_disk_bytes=35000, spill_bytes=5000, directory=directory,
+		typecode='f')
+	small = cache.put("small", [audiogen.blocks.block([0.5] * 1000)])
+	assert small.path is None and cache.memory_bytes == 4000
+	for key in range(3):
+		cache.put(key, audiogen.blocks.from_samples([0.25] * 4000))
+	assert list(cache.entries) == ["small", 1, 2]
+	assert cache.get(2).path.startswith(directory)
+	assert list(cache.get(2).samples()) == [0.25] * 4000
+	assert len(os.listdir(directory)) == 2
+
+def test_sample_cache_replays_exact_blocks():
+	samples = [math.sin(i / 10.) for i in range(3000)]
+	cache = audiogen.cache.SampleCache(spill_bytes=10000, directory=tempfile.mkdtemp())
+	for key in ("memory", "disk"):
+		entry = cache.put(key, audiogen.blocks.from_samples(samples, 1000))
+		replayed = list(entry.blocks(1000))
+		assert all(isinstance(b, array.array) and b.typecode == 'd' for b in replayed)
+		assert list(audiogen.blocks.to_samples(replayed)) == samples
+
+def test_cache_finite_samples():
+	calls = []
+
+	@audiogen.sampler.cache_finite_samples
+	def render(frequency):
+		calls.append(frequency)
+		return audiogen.util.crop(audiogen.generators.dds(frequency), 0.1)
+
+	first, second = list(render(440)), list(render(440))
+	assert calls == [440]
+	assert first == second and len(first) == 4410
+
+def test_render_cache_serves_identical_pcm():
+	expected = io.BytesIO()
+	audiogen.sampler.write_wav(expected, audiogen.beep(1000, 0.5))
+	audiogen.cache.use_render_cache(tempfile.mkdtemp())
+	try:
+		for i in range(2):
+			render = audiogen.beep(1000, 0.5)
+			assert isinstance(render, audiogen.cache.PcmRender)
+			output = io.BytesIO()
+			audiogen.sampler.write_wav(output, render)
+			assert output.getvalue() == expected.getvalue()
+		# decoded samples re-encode to the same PCM
+		output = io.BytesIO()
+		audiogen.sampler.write_wav(output, iter(list(audiogen.beep(1000, 0.5))))
+		assert output.getvalue() == expected.getvalue()
+	finally:
+		audiogen.cache.use_render_cache(None)
+
+def test_wavetable_closes_phase_loop():
+	table = audiogen.generators.wavetable(440)
+	assert len(table) == 2205
+	samples = list(itertools.islice(audiogen.generators.tone(440, use_wavetable=True), 5000))
+	for i, sample in enumerate(samples):
+		assert abs(sample - math.sin(2 * math.pi * 440 * i / 44100)) < 1e-9
+	blocks = audiogen.generators.wavetable_blocks(440, block_size=1000)
+	assert list(itertools.islice(audiogen.blocks.to_samples(blocks), 5000)) == samples
+	with pytest.raises(ValueError):
+		audiogen.generators.tone(0, use_wavetable=True)
+
+def test_tone_frame_rate():
+	tone = list(itertools.islice(audiogen.generators.tone(440, frame_rate=8000), 1000))
+	with audiogen.config.using(frame_rate=8000):
+		expected = list(itertools.islice(audiogen.generators.tone(440), 1000))
+	assert tone == expected
+
+def test_frequency_modulated_tone():
+	samples = list(itertools.islice(audiogen.generators.tone(iter([11025] * 8)), 8))
+	for sample, test in zip(samples, [0, 1, 0, -1] * 2):
+		assert abs(sample - test) < 1e-9
+
+def test_dds_lut_options():
+	phase, delta = audiogen.generators.DDS._accumulator(440)
+	exact = [math.sin(2 * math.pi * (delta * (i + 1) % 2**24) / 2**24) for i in range(3000)]
+
+	def error(dds):
+		samples = itertools.islice(dds.dds(440), 3000)
+		return max(abs(sample - test) for sample, test in zip(samples, exact))
+
+	truncated = error(audiogen.generators.DDS(lutBits=8))
+	interpolated = error(audiogen.generators.DDS(lutBits=8, interpolate=True))
+	assert interpolated < truncated / 10
+	quarter = audiogen.generators.DDS(quarterWave=True, lutTypecode='f')
+	assert error(quarter) == error(audiogen.generators.DDS(lutTypecode='f'))
+	assert len(quarter.lut) == 2**12 + 1
+
+def test_dds_load_lut():
+	dds = audiogen.generators.DDS(lutBits=10)
+	filename = os.path.join(tempfile.mkdtemp(), "lut")
+	dds.saveLut(filename)
+	loaded = audiogen.generators.DDS(lutBits=10, lut=filename)
+	assert list(itertools.islice(loaded.dds(440), 100)) == list(itertools.islice(dds.dds(440), 100))
+
+def test_arcfour_rfc_6229_vector():
+	keystream = audiogen.noise.arcfour(bytes.fromhex("0102030405"))
+	assert bytes(itertools.islice(keystream, 16)).hex() == "b2396305f03dc027ccc3524a0a1118a8"
+
+def test_keyed_white_noise_is_seekable():
+	samples = list(itertools.islice(
+		audiogen.blocks.to_samples(audiogen.noise.white_noise_blocks("key", block_size=1000)), 5000))
+	assert all(-1 <= sample < 1 for sample in samples)
+	segment = audiogen.noise.white_noise_segment("key", 1234, 100)
+	assert list(segment) == samples[1234:1334]
+	words = audiogen.noise.philox_key("key")
+	first = audiogen.noise.philox(1, words)[0]
+	assert samples[0] == (first >> 11) * 2.0 ** -52 - 1
+
+def test_colored_noise_is_seekable_and_sloped():
+	# the FIR colored noise path needs NumPy
+	numpy = pytest.importorskip("numpy")
+	samples = numpy.array(list(itertools.islice(
+		audiogen.blocks.to_samples(audiogen.noise.pink_noise_blocks("key")), 2**16)))
+	segment = audiogen.noise.colored_noise_segment("pink", "key", 20000, 100)
+	assert numpy.allclose(segment, samples[20000:20100])
+	pink = list(itertools.islice(audiogen.noise.pink_noise("key", 20000), 100))
+	assert numpy.allclose(pink, segment)
+	# pink noise has equal power per octave, so about 3 dB less per bin each octave
+	spectrum = numpy.abs(numpy.fft.rfft(samples)) ** 2
+	low, high = spectrum[1000:2000].mean(), spectrum[2000:4000].mean()
+	assert 1.7 < low / high < 2.3
+
+def test_write_wav_in_worker_processes():
+	import functools
+	channels = [functools.partial(audiogen.beep, 440, 0.5), functools.partial(audiogen.beep, 880, 1)]
+	expected, parallel = io.BytesIO(), io.BytesIO()
+	audiogen.sampler.write_wav(expected, [channel() for channel in channels])
+	audiogen.sampler.write_wav(parallel, channels, processes=True)
+	assert parallel.getvalue() == expected.getvalue()
+
+def test_seekable_sources_render_any_segment():
+	tone = audiogen.seekable.Tone(440)
+	expected = itertools.islice(audiogen.generators.dds(440), 5000, 5100)
+	assert list(tone.render(5000, 100)) == list(expected)
+	mixed = audiogen.util.mixer(
+		(tone, audiogen.seekable.Noise("key")),
+		((audiogen.util.constant(0.5), audiogen.util.constant(0.25)),))[0]
+	channel = audiogen.seekable.Crop(audiogen.util.volume(mixed, -3), 1)
+	assert isinstance(channel.source, audiogen.seekable.Envelope)
+	samples = list(channel)
+	assert len(samples) == 44100
+	assert list(channel.render(30000, 100)) == samples[30000:30100]
+
+def test_write_wav_in_time_segments():
+	channel = audiogen.seekable.Crop(audiogen.seekable.Tone(440), 1)
+	expected, segmented = io.BytesIO(), io.BytesIO()
+	audiogen.sampler.write_wav(expected, channel)
+	saved_seconds = audiogen.parallel.SEGMENT_SECONDS
+	audiogen.parallel.SEGMENT_SECONDS = 0.25
+	try:
+		audiogen.sampler.write_wav(segmented, channel, workers=2)
+	finally:
+		audiogen.parallel.SEGMENT_SECONDS = saved_seconds
+	assert segmented.getvalue() == expected.getvalue()
+
+def test_mixer_blocks_matrix():
+	inputs = [audiogen.blocks.from_samples(range(3000)), audiogen.blocks.constant(1)]
+	ramp = audiogen.blocks.from_samples(x / 3000. for x in range(3000))
+	left, right = audiogen.util.mixer_blocks(inputs, ((0.5, 2), (ramp, 0)))
+	# outputs may be read unevenly
+	right = list(audiogen.blocks.to_samples(right))
+	left = list(audiogen.blocks.to_samples(left))
+	assert left == [x * 0.5 + 2 for x in range(3000)]
+	assert right == [x * (x / 3000.) for x in range(3000)]
+
+def test_frames_write_wav_and_filters():
+	def stereo():
+		return audiogen.blocks.lockstep([
+			audiogen.blocks.from_samples(itertools.islice(audiogen.generators.dds(440), 3000)),
+			audiogen.blocks.from_samples(itertools.islice(audiogen.generators.dds(660), 3000))])
+	expected, framed = io.BytesIO(), io.BytesIO()
+	audiogen.sampler.write_wav(expected, [
+		itertools.islice(audiogen.generators.dds(440), 3000),
+		itertools.islice(audiogen.generators.dds(660), 3000)])
+	audiogen.sampler.write_wav(framed, stereo(), frames=True)
+	assert framed.getvalue() == expected.getvalue()
+
+	low_pass = audiogen.filters.butterworth("low_pass", 1000)
+	filtered = list(audiogen.blocks.to_tuples(low_pass.frames(stereo())))
+	right = list(audiogen.blocks.to_samples(low_pass.blocks(
+		audiogen.blocks.from_samples(itertools.islice(audiogen.generators.dds(660), 3000)))))
+	assert [frame[1] for frame in filtered] == right
+
+def test_channelize_frames():
+	pulled = []
+	source = (pulled.append(i) or (i, -i, 0) for i in range(3000))
+	left, right = audiogen.util.channelize(source, 2)
+	assert pulled == []
+	assert list(right) == [-i for i in range(3000)]
+	assert list(left) == list(range(3000))
+
+def test_play_to_file_device():
+	expected, played = io.BytesIO(), io.BytesIO()
+	audiogen.sampler.write_wav(expected, audiogen.util.crop(audiogen.generators.dds(440), 0.5))
+	player = audiogen.sampler.play(
+		audiogen.util.crop(audiogen.generators.dds(440), 0.5),
+		device=audiogen.playback.FileDevice(played))
+	assert played.getvalue() == expected.getvalue()
+	assert player.frames_played == 22050
+	assert player.underruns == 0
+
+def test_ring_buffer_wraps():
+	ring = audiogen.playback.RingBuffer(10)
+	out = bytearray(10)
+	assert ring.write(b"abcdefgh") == 8
+	assert ring.read_into(out, 6) == 6
+	assert ring.write(b"ijklmnopqr") == 8
+	assert ring.read_into(out, 10) == 10
+	assert bytes(out) == b"ghijklmnop"
+
+def test_async_wav_stream():
+	import asyncio
+
+	async def collect():
+		return [chunk async for chunk in audiogen.streaming.aiter_wav(
+			audiogen.util.crop(audiogen.generators.dds(440), 0.5), chunk_frames=1000)]
+	chunks = asyncio.run(collect())
+	expected = io.BytesIO()
+	audiogen.sampler.write_wav(
+		expected, audiogen.util.crop(audiogen.generators.dds(440), 0.5), seekable=False)
+	assert b"".join(chunks) == expected.getvalue()
+	assert len(chunks) == 24
+
+def test_instrument_profile():
+	gen = audiogen.util.hard_clip(iter([0, 2, -2, 0.5]))
+	assert audiogen.instrument.stage("unprofiled", gen) is gen
+	with audiogen.instrument.profile() as stats:
+		audiogen.sampler.write_wav(io.BytesIO(), audiogen.util.hard_clip(iter([0, 2, -2, 0.5])))
+	assert stats.stages["hard_clip"].samples == 4
+	assert stats.stages["write"].bytes == 8
+	assert stats.counters["clipped samples"] == 2
+	assert "hard_clip" in stats.report()
+
+def test_instrument_profile_is_per_context():
+	import threading
+	import contextvars
+	built = []
+	with audiogen.instrument.profile() as stats:
+		thread = threading.Thread(target=lambda: built.append(
+			audiogen.instrument.stage("other thread", iter([0.5]))))
+		thread.start()
+		thread.join()
+		list(contextvars.copy_context().run(audiogen.instrument.stage, "copied", iter([0.5])))
+	assert list(stats.stages) == ["copied"]
+	assert audiogen.instrument.current() is None
+
+def test_clip_blocks_policies():
+	source = [0, 2, -3, 0.5] + [0] * 500
+	stats = audiogen.util.ClipStats()
+	clipped = list(audiogen.blocks.to_samples(audiogen.util.clip_blocks(
+		audiogen.blocks.from_samples(source, 100), stats=stats)))
+	assert clipped[:4] == [0, 1, -1, 0.5]
+	assert (stats.count, stats.peak, stats.first, stats.last) == (2, 2, 1, 2)
+	for policy in ("soft", "limit"):
+		shaped = list(audiogen.util.hard_clip(iter(source), policy=policy))
+		assert len(shaped) == len(source)
+		assert max(abs(s) for s in shaped) <= 1
+
+def test_loudness_normalize_blocks():
+	def sine(level):
+		return audiogen.blocks.from_samples(
+			level * math.sin(2 * math.pi * 997 * i / 44100.) for i in range(88200))
+	assert abs(audiogen.dynamics.integrated_loudness(sine(1)) + 3.01) < 0.01
+	normalized = list(audiogen.dynamics.normalize_blocks(sine(0.01), target=-30))
+	assert sum(len(b) for b in normalized) == 88200
+	assert abs(audiogen.dynamics.integrated_loudness(normalized) + 30) < 0.01
+	limited = audiogen.blocks.to_samples(audiogen.dynamics.normalize_blocks(sine(0.5), target=0))
+	assert max(abs(s) for s in limited) <= 10 ** (-1 / 20.)
+
+def test_dynamics_pass_empty_blocks():
+	def source():
+		for block in audiogen.blocks.from_samples(
+				0.5 * math.sin(2 * math.pi * 997 * i / 44100.) for i in range(44100)):
+			yield array.array('d')
+			yield block
+	normalized = list(audiogen.dynamics.normalize_blocks(source(), target=-30, window=0.1))
+	assert sum(len(b) for b in normalized) == 44100
+	limited = list(audiogen.dynamics.limit_blocks(source(), ceiling=0.25))
+	assert sum(len(b) for b in limited) == 44100
+	assert max(abs(s) for s in audiogen.blocks.to_samples(limited)) <= 0.25
+
+def test_concurrent_render_configs():
+	import asyncio
+	import threading
+
+	def render(rate):
+		with audiogen.config.using(frame_rate=rate, block_size=256):
+			out = io.BytesIO()
+			audiogen.sampler.write_wav(
+				out, audiogen.util.crop(audiogen.generators.dds(440), 0.5), seekable=False)
+			return out.getvalue()
+	expected = {rate: render(rate) for rate in (8000, 48000)}
+	rendered = {}
+	threads = [
+		threading.Thread(target=lambda rate=rate: rendered.update({rate: render(rate)}))
+		for rate in (8000, 48000)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert rendered == expected
+	assert audiogen.sampler.FRAME_RATE == 44100
+
+	async def stream(rate):
+		with audiogen.config.using(frame_rate=rate):
+			chunks = [chunk async for chunk in audiogen.streaming.aiter_wav(
+				audiogen.util.crop(audiogen.generators.dds(440), 0.5))]
+		return b"".join(chunks)
+
+	async def both():
+		return await asyncio.gather(stream(8000), stream(48000))
+	assert asyncio.run(both()) == [expected[8000], expected[48000]]
+
+def test_resample_blocks():
+	def sine(rate, count):
+		return [math.sin(2 * math.pi * 1000 * i / rate) for i in range(count)]
+	for rate in (48000, 8000):
+		resampled = list(audiogen.blocks.to_samples(audiogen.resample.resample_blocks(
+			audiogen.blocks.from_samples(sine(44100, 22050)), 44100, rate)))
+		assert len(resampled) == rate // 2
+		# aligned with the input, away from the edges
+		expected = sine(rate, rate // 2)[rate // 10:]
+		assert max(abs(a - b) for a, b in zip(resampled[rate // 10:-rate // 10], expected)) < 1e-3
+	assert audiogen.resample.table(160, 147) is audiogen.resample.table(160, 147)
+
+def test_zero_crossings_and_loop_points():
+	assert list(audiogen.util.zero_crossings([1, -1, 0, 2, -3])) == [1, 2, 4]
+	assert list(audiogen.util.zero_crossings([1, -1, 0, 2, -3], "rising")) == [2]
+	clip = [math.sin(2 * math.pi * 441.7 * i / 44100 + 0.3) for i in range(44100)]
+	cropped = list(audiogen.util.crop_at_zero_crossing(iter(clip), 0.5))
+	assert abs(len(cropped) - 22050) < 0.1 * 44100
+	assert abs(cropped[-1]) < 0.05
+	clip_blocks = audiogen.blocks.from_samples(clip, 1000)
+	blocks = audiogen.util.crop_blocks_at_zero_crossing(clip_blocks, 0.5, error=0)
+	assert len(list(audiogen.blocks.to_samples(blocks))) == 22050
+	assert audiogen.util.loop_discontinuity(clip) > 1
+	end, score = audiogen.util.find_loop_point(clip)
+	assert score > 0.999
+	assert audiogen.util.loop_discontinuity(clip[:end]) <= 1
+	looped = audiogen.util.loop(iter(clip), seamless=True)
+	assert list(itertools.islice(looped, end + 1))[end] == clip[0]